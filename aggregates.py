@@ -0,0 +1,107 @@
+# coding: utf-8
+import sqlite3
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date
+from typing import Optional
+
+# Running aggregates of the consumption, kept up to date by ingestion so that they never need a scan of the
+# history. Sums are in the units of `consumption.value` (the average power over a slice, in W), so half of a sum is
+# an energy in Wh. The tables are created and backfilled by a migration.
+
+UPSERT_DAY = """INSERT INTO consumption_day VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (year, month, day) DO UPDATE SET
+        total = total + excluded.total, slices = slices + excluded.slices,
+        min = MIN(min, excluded.min), max = MAX(max, excluded.max)"""
+
+UPSERT_MONTH = """INSERT INTO consumption_month VALUES (?, ?, ?, ?)
+    ON CONFLICT (year, month) DO UPDATE SET total = total + excluded.total, slices = slices + excluded.slices"""
+
+UPSERT_WEEKLY = """INSERT INTO consumption_weekly VALUES (?, ?, ?, ?)
+    ON CONFLICT (weekday, slice) DO UPDATE SET total = total + excluded.total, count = count + excluded.count"""
+
+
+class Aggregator:
+    """
+    Accumulates the readings written during an ingest, in O(1) each, and applies them to the aggregate tables with
+    one upsert per day, month and weekly slot touched.
+    """
+
+    def __init__(self):
+        # (year, month, day) -> [total, slices, min, max]
+        self.days: dict[tuple[int, int, int], list[int]] = {}
+        # (year, month) -> [total, slices]
+        self.months: dict[tuple[int, int], list[int]] = defaultdict(lambda: [0, 0])
+        # (weekday, slice), Monday being 0 -> [total, count]
+        self.weekly: dict[tuple[int, int], list[int]] = defaultdict(lambda: [0, 0])
+        # days where a reading was replaced, whose min and max may have been the replaced value
+        self.replaced: set[tuple[int, int, int]] = set()
+
+    def add(self, day: date, slice_idx: int, value: int, old: Optional[int] = None):
+        """
+        Accounts for a reading of `value` written for a slice, that replaced `old` if the slice already had one.
+        """
+        new = int(old is None)
+        delta = value - (old or 0)
+        key = (day.year, day.month, day.day)
+        if (acc := self.days.get(key)) is None:
+            self.days[key] = [delta, new, value, value]
+        else:
+            acc[0] += delta
+            acc[1] += new
+            acc[2] = min(acc[2], value)
+            acc[3] = max(acc[3], value)
+        if not new:
+            self.replaced.add(key)
+        month = self.months[key[:2]]
+        month[0] += delta
+        month[1] += new
+        weekly = self.weekly[(day.weekday(), slice_idx)]
+        weekly[0] += delta
+        weekly[1] += new
+
+    def flush(self, cur: sqlite3.Cursor):
+        """
+        Applies what was accumulated, in the current transaction, after the readings themselves were written.
+        """
+        cur.executemany(UPSERT_DAY, [(*k, *v) for k, v in self.days.items()])
+        cur.executemany("UPDATE consumption_day SET (min, max) = (SELECT MIN(value), MAX(value) FROM consumption_all c "
+                        "WHERE c.year = :year AND c.month = :month AND c.day = :day) "
+                        "WHERE year = :year AND month = :month AND day = :day",
+                        [dict(year=y, month=m, day=d) for y, m, d in self.replaced])
+        cur.executemany(UPSERT_MONTH, [(*k, *v) for k, v in self.months.items()])
+        cur.executemany(UPSERT_WEEKLY, [(*k, *v) for k, v in self.weekly.items()])
+        self.__init__()
+
+
+def month_totals(cur: sqlite3.Cursor) -> list[tuple[int, int, float, float, int, Optional[int]]]:
+    """
+    Gives, for each stored month: (year, month, energy in Wh, share of the days of the month that have data, number of
+    those days that only have a daily total, peak power in VA).
+
+    Days without a load curve are counted from `consumption_daily`, which also gives the peaks.
+    """
+    rows = cur.execute("""
+        SELECT year, month, SUM(energy), SUM(slices) / 48.0, SUM(estimated), MAX(peak) FROM (
+            SELECT year, month, day, total / 2.0 AS energy, slices, 0 AS estimated, NULL AS peak FROM consumption_day
+            UNION ALL
+            SELECT year, month, day, IIF(c.year IS NULL, d.energy, 0), IIF(c.year IS NULL, 48, 0),
+                c.year IS NULL, d.peak
+            FROM consumption_daily d LEFT JOIN consumption_day c USING (year, month, day)
+        ) GROUP BY year, month ORDER BY year, month""").fetchall()
+    return [(year, month, energy, days / monthrange(year, month)[1], estimated, peak)
+            for year, month, energy, days, estimated, peak in rows]
+
+
+def estimated_days(cur: sqlite3.Cursor, start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """
+    Gives the number of days between `start` and `end` (inclusive, unbounded by default) that only have a daily total,
+    and so are estimated in `consumption_approx`.
+    """
+    start = start or date.min
+    end = end or date.max
+    return cur.execute("""
+        SELECT COUNT(*) FROM consumption_daily d
+        WHERE (d.year, d.month, d.day) BETWEEN (?, ?, ?) AND (?, ?, ?)
+        AND NOT EXISTS (SELECT 1 FROM consumption_day c WHERE c.year = d.year AND c.month = d.month AND c.day = d.day)
+        """, (start.year, start.month, start.day, end.year, end.month, end.day)).fetchone()[0]
@@ -0,0 +1,160 @@
+# coding: utf-8
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+
+import numpy as np
+
+import archive
+import db
+import history
+from edf_plan import EdfPlan
+
+SEASONS = ["Hiver", "Printemps", "Été", "Automne"]
+WEEKDAYS = ["Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi", "Samedi", "Dimanche"]
+TEMPO_COLORS = ["Bleu", "Blanc", "Rouge"]
+
+# 00:00 to 06:00
+NIGHT_SLICES = slice(0, 12)
+
+
+@dataclass
+class Analytics:
+    """
+    Load profile statistics over the whole consumption history. Energies are in Wh, powers in W.
+    """
+    first_day: date
+    last_day: date
+    # median over the last year of the daily 10th percentile of the night-time power
+    baseload: float
+    # (n_months,) monthly baseload and the matching "YYYY-MM" labels
+    baseload_months: list[str]
+    baseload_monthly: np.ndarray
+    # (7, 48) and (4, 48) average energy per slice
+    weekday_profile: np.ndarray
+    season_profile: np.ndarray
+    # (3,) total energy and number of days for each Tempo colour (days running from 06:00 to 06:00)
+    tempo_energy: np.ndarray
+    tempo_days: np.ndarray
+    # per (month 1-12, year) energy, NaN for incomplete months
+    monthly_energy: dict[tuple[int, int], float]
+    # top days as (date, total energy, peak power)
+    peak_days: list[tuple[date, float, float]]
+
+    def year_over_year(self) -> list[tuple[str, float, float, float]]:
+        """
+        Gives (YYYY-MM, energy, energy a year before, relative delta) for each month that has a match a year before.
+        """
+        res = []
+        for (year, month), energy in sorted(self.monthly_energy.items()):
+            previous = self.monthly_energy.get((year - 1, month))
+            if previous is not None and not np.isnan(energy) and not np.isnan(previous) and previous:
+                res.append((f"{year:04d}-{month:02d}", energy, previous, (energy - previous) / previous))
+        return res
+
+
+def compute(hist: history.History, peak_count: int = 10) -> Analytics:
+    """
+    Computes the statistics of `hist` with array operations over the whole history.
+    """
+    values = hist.values
+    known = ~np.isnan(values)
+    complete = known.all(axis=1)
+    daily = np.where(complete, np.nansum(values, axis=1), np.nan)
+
+    night = values[:, NIGHT_SLICES] * 2
+    with np.errstate(all="ignore"):
+        night_base = np.nanpercentile(night, 10, axis=1)
+    last_year = night_base[-365:]
+    baseload = float(np.nanmedian(last_year)) if not np.isnan(last_year).all() else float("nan")
+
+    months = hist.days.astype("datetime64[M]")
+    month_idx = (months - months[0]).astype(np.int64) if len(hist) else np.zeros(0, dtype=np.int64)
+    n_months = int(month_idx[-1]) + 1 if len(hist) else 0
+    baseload_monthly = _group_nanmedian(night_base, month_idx, n_months)
+    baseload_months = [str(months[0] + i) for i in range(n_months)]
+
+    weekday = (hist.days.astype(np.int64) + 3) % 7
+    month_of_year = months.astype(np.int64) % 12
+    season = (month_of_year + 1) % 12 // 3
+    weekday_profile = _group_nanmean(values, weekday, 7)
+    season_profile = _group_nanmean(values, season, 4)
+
+    colors = EdfPlan.TEMPO.day_kinds(hist.days, hist.tempo)
+    tempo_energy = np.array([np.nansum(np.where(colors == c, values, 0)) for c in (1, 2, 3)])
+    tempo_days = np.array([np.count_nonzero(hist.tempo[1:] == c) for c in (1, 2, 3)])
+
+    monthly_sum = np.bincount(month_idx, weights=np.nan_to_num(daily), minlength=n_months)
+    monthly_complete = np.bincount(month_idx, weights=complete, minlength=n_months) == \
+        np.bincount(month_idx, minlength=n_months)
+    monthly_energy = {}
+    for i in range(n_months):
+        year, month = divmod(int((months[0] + i).astype(np.int64)), 12)
+        monthly_energy[(year + 1970, month + 1)] = monthly_sum[i] if monthly_complete[i] else float("nan")
+
+    order = np.argsort(np.nan_to_num(daily, nan=-1))[::-1][:peak_count]
+    peak_days = [(hist.days[i].astype(date), float(daily[i]), float(np.nanmax(values[i]) * 2))
+                 for i in order if not np.isnan(daily[i])]
+
+    return Analytics(
+        first_day=hist.days[0].astype(date) if len(hist) else None,
+        last_day=hist.days[-1].astype(date) if len(hist) else None,
+        baseload=baseload,
+        baseload_months=baseload_months,
+        baseload_monthly=baseload_monthly,
+        weekday_profile=weekday_profile,
+        season_profile=season_profile,
+        tempo_energy=tempo_energy,
+        tempo_days=tempo_days,
+        monthly_energy=monthly_energy,
+        peak_days=peak_days,
+    )
+
+
+def _group_nanmean(values: np.ndarray, groups: np.ndarray, n: int) -> np.ndarray:
+    """
+    Averages the rows of `values` by group, ignoring NaN. Gives an (n, values.shape[1]) array.
+    """
+    sums = np.zeros((n, values.shape[1]))
+    counts = np.zeros((n, values.shape[1]))
+    np.add.at(sums, groups, np.nan_to_num(values))
+    np.add.at(counts, groups, ~np.isnan(values))
+    with np.errstate(all="ignore"):
+        return sums / counts
+
+
+def _group_nanmedian(values: np.ndarray, groups: np.ndarray, n: int) -> np.ndarray:
+    """
+    Gives the median of `values` for each group (groups being sorted), ignoring NaN.
+    """
+    bounds = np.searchsorted(groups, np.arange(n + 1))
+    with np.errstate(all="ignore"):
+        return np.array([np.nanmedian(values[a:b]) if np.any(~np.isnan(values[a:b])) else np.nan
+                         for a, b in zip(bounds, bounds[1:])])
+
+
+_cache: Optional[tuple[int, history.History, Analytics]] = None
+
+
+def get() -> Analytics:
+    """
+    Gives the statistics for the current data, computing them only if the data changed since the last call.
+
+    The history is kept in memory between calls. Since ingestion only ever appends days or replaces the last stored
+    one, only the days from the last known one onward are reloaded from the database.
+    """
+    global _cache
+    version = db.data_version()
+    if _cache is not None and _cache[0] == version:
+        return _cache[2]
+
+    hist = None
+    if _cache is not None and len(cached := _cache[1]):
+        stored = archive.stored_days(db.cur)
+        if stored is not None and stored[0] == cached.days[0].astype(date):
+            hist = cached.extend(history.load_history(start=cached.days[-1].astype(date)))
+    if hist is None:
+        hist = history.load_history()
+
+    _cache = (version, hist, compute(hist))
+    return _cache[2]
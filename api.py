@@ -0,0 +1,181 @@
+# coding: utf-8
+import enum
+import hashlib
+import json
+import math
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Callable, Optional
+
+from fastapi import APIRouter, HTTPException, Request, Response
+
+import data_cache
+import db
+import fetch_edf
+from edf_plan import EdfPlan, DATE_RANGE_FILTER, query_plan_prices_period, query_params
+
+# Read-only JSON API for dashboards. Every response carries a strong ETag, so that clients polling with If-None-Match
+# get a 304 without anything being computed as long as the data they asked for didn't change.
+
+router = APIRouter(prefix="/api")
+
+# total size of the responses for periods that ended before today kept across ingests, the least recently used being
+# dropped; responses bigger than a quarter of it (years of slots) are not kept
+CLOSED_BYTES = 64 * 1024 * 1024
+
+# the data is the meter's and may change with any ingest, so clients must always check with the server
+CACHE_CONTROL = "private, no-cache"
+
+
+class Resolution(str, enum.Enum):
+    SLOT = "slot"
+    HOUR = "hour"
+    DAY = "day"
+    MONTH = "month"
+
+    def period_sql(self) -> str:
+        """
+        Gives an SQL expression of the period a row belongs to. Assumes `c` is a table with `date` (YYYY-MM-DD) and
+        `slice` (0-47) columns.
+        """
+        match self:
+            case Resolution.SLOT:
+                return "c.date || printf(' %02d:%02d', c.slice / 2, c.slice % 2 * 30)"
+            case Resolution.HOUR:
+                return "c.date || printf(' %02d:00', c.slice / 2)"
+            case Resolution.DAY:
+                return "c.date"
+            case Resolution.MONTH:
+                return "strftime('%Y-%m', c.date)"
+
+
+# key -> (ETag, body) of the responses for closed periods
+_closed: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+_closed_bytes = 0
+
+
+def _on_data_change(change: fetch_edf.DataChange):
+    global _closed_bytes
+    # a Tempo colour also prices the first hours of the next day
+    end = change.end + timedelta(days=1) if change.end < date.max else change.end
+    for key in [key for key in _closed if key[1] <= end and key[2] >= change.start]:
+        _closed_bytes -= len(_closed.pop(key)[1])
+
+
+fetch_edf.change_callbacks.append(_on_data_change)
+
+
+def _etag(version: int, key: tuple) -> str:
+    return f'"{version}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}"'
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def respond(request: Request, key: tuple, compute: Callable[[], object]) -> Response:
+    """
+    Answers a request for `key` (the endpoint, the first and last days, then the other parameters) with the JSON
+    result of `compute`, or 304 if the client has it already.
+
+    Results for periods that ended before today are kept until an ingest changes the data of one of their days, with
+    the ETag they were first given; the others are computed once per data version.
+    """
+    global _closed_bytes
+    version = db.data_version()
+    closed = key[2] < date.today()
+    entry = _closed.get(key) if closed else None
+    etag = entry[0] if entry is not None else _etag(version, key)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if entry is not None:
+        _closed.move_to_end(key)
+        body = entry[1]
+    elif closed:
+        body = json.dumps(compute(), separators=(",", ":")).encode()
+        if len(body) <= CLOSED_BYTES // 4:
+            _closed[key] = etag, body
+            _closed_bytes += len(body)
+            while _closed_bytes > CLOSED_BYTES:
+                _closed_bytes -= len(_closed.popitem(last=False)[1][1])
+    else:
+        body = data_cache.cached(("api",) + key, lambda: json.dumps(compute(), separators=(",", ":")).encode())
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def check_range(start: date, end: date):
+    if start > end:
+        raise HTTPException(400, "start must not be after end")
+
+
+def parse_plans(plans: Optional[str]) -> list[EdfPlan]:
+    if plans is None:
+        return list(EdfPlan)
+    try:
+        return [EdfPlan(plan) for plan in plans.split(",")]
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+def query_consumption(start: date, end: date, resolution: Resolution) -> list[dict]:
+    rows = db.cur.execute(f"""
+        SELECT {resolution.period_sql()}, SUM(c.value) / 2 FROM consumption_all c WHERE {DATE_RANGE_FILTER}
+        GROUP BY 1 ORDER BY 1""", query_params(start, end)).fetchall()
+    return [{"period": period, "wh": value} for period, value in rows]
+
+
+def query_tempo(start: date, end: date) -> list[dict]:
+    rows = db.cur.execute("SELECT date, tempo FROM tempo WHERE date BETWEEN ? AND ? AND tempo != 0 ORDER BY date",
+                          (start.isoformat(), end.isoformat())).fetchall()
+    return [{"date": day, "color": ("blue", "white", "red")[color - 1]} for day, color in rows]
+
+
+def query_costs(start: date, end: date, resolution: Resolution, plans: list[EdfPlan], price_mode: str) -> list[dict]:
+    rows = db.cur.execute(query_plan_prices_period(plans, price_mode, resolution.period_sql()),
+                          query_params(start, end)).fetchall()
+    return [{
+        "period": period,
+        "wh": value,
+        # in €, None where the prices are unknown
+        "costs": {p.value: None if c is None or math.isinf(c) else c / 10000000 for p, c in zip(plans, costs)},
+    } for period, value, *costs in sorted(rows)]
+
+
+@router.get("/consumption")
+async def consumption(request: Request, start: date, end: date, resolution: Resolution = Resolution.DAY):
+    """
+    Measured consumption in Wh for each period between `start` and `end` (inclusive) that has data.
+    """
+    check_range(start, end)
+    return respond(request, ("consumption", start, end, resolution.value),
+                   lambda: query_consumption(start, end, resolution))
+
+
+@router.get("/tempo")
+async def tempo(request: Request, start: date, end: date):
+    """
+    Known Tempo colours of the days between `start` and `end` (inclusive).
+    """
+    check_range(start, end)
+    return respond(request, ("tempo", start, end), lambda: query_tempo(start, end))
+
+
+@router.get("/costs")
+async def costs(request: Request, start: date, end: date, resolution: Resolution = Resolution.DAY,
+                plans: Optional[str] = None, price_mode: str = "real"):
+    """
+    Consumption in Wh and its cost in € with each plan (`plans`, comma-separated, all by default) for each period
+    between `start` and `end` (inclusive) that has data. `price_mode` is "real" for the rates in force at the time,
+    "current" for today's.
+    """
+    check_range(start, end)
+    if price_mode not in ("real", "current"):
+        raise HTTPException(400, "price_mode must be real or current")
+    plan_list = parse_plans(plans)
+    return respond(request, ("costs", start, end, resolution.value, tuple(p.value for p in plan_list), price_mode),
+                   lambda: query_costs(start, end, resolution, plan_list, price_mode))
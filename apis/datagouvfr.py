@@ -1,19 +1,29 @@
 # coding: utf-8
 from aiohttp_requests import requests
 
+import config
+
 DATA_GOUV_ROOT = "https://www.data.gouv.fr"
-API_FORMAT = DATA_GOUV_ROOT + "/api/1/{endpoint}"
+API_FORMAT = "{root}/api/1/{endpoint}"
+RESOURCE_FORMAT = "{root}/fr/datasets/r/{resource}"
+
+# CSV resources of the regulated Bleu tariffs, by plan
+TARIFF_RESOURCES = {
+    "base": "c13d05e5-9e55-4d03-bf7e-042a2ade7e49",
+    "hphc": "f7303b3a-93c7-4242-813d-84919034c416",
+}
 
 
 async def get_resource_info(dataset: str, resource: str):
-    url = API_FORMAT.format(endpoint=f"datasets/{dataset}/resources/{resource}")
+    url = API_FORMAT.format(root=config.config.get("DATA_GOUV_ROOT") or DATA_GOUV_ROOT,
+                            endpoint=f"datasets/{dataset}/resources/{resource}")
     req = await requests.get(url)
     req.raise_for_status()
     return await req.json()
 
 
 async def get_resource_content(resource: str):
-    url = f"{DATA_GOUV_ROOT}/fr/datasets/r/{resource}"
+    url = RESOURCE_FORMAT.format(root=config.config.get("DATA_GOUV_ROOT") or DATA_GOUV_ROOT, resource=resource)
     req = await requests.get(url)
     req.raise_for_status()
     return await req.text("utf-8")
@@ -5,11 +5,13 @@ from typing import Optional
 from aiohttp_requests import requests
 import config
 
-API_FORMAT = "https://www.myelectricaldata.fr/{endpoint}/{meter_id}{params}/cache/"
+MED_ROOT = "https://www.myelectricaldata.fr"
+API_FORMAT = "{root}/{endpoint}/{meter_id}{params}/cache/"
 
 
 async def fetch_api(endpoint, range: Optional[tuple[date, date]] = None):
-    url = API_FORMAT.format(endpoint=endpoint, meter_id=config.config["METER_ID"],
+    url = API_FORMAT.format(root=config.config.get("MED_API_ROOT") or MED_ROOT, endpoint=endpoint,
+                            meter_id=config.config["METER_ID"],
                             params="" if range is None else f"/start/{range[0]}/end/{range[1]}")
     req = await requests.get(url, headers={"Authorization": config.config["MED_TOKEN"]})
     res = await req.json()
@@ -21,3 +23,17 @@ async def fetch_api(endpoint, range: Optional[tuple[date, date]] = None):
 
 async def get_meter_info():
     return await fetch_api("contracts")
+
+
+def subscribed_power(meter_info) -> int:
+    """
+    Gives the subscribed power in kVA from the response of `get_meter_info`.
+    """
+    return int(meter_info["customer"]["usage_points"][0]["contracts"]["subscribed_power"].split(" ")[0])
+
+
+def activation_date(meter_info) -> date:
+    """
+    Gives the last activation date of the meter from the response of `get_meter_info`.
+    """
+    return date.fromisoformat(meter_info["customer"]["usage_points"][0]["contracts"]["last_activation_date"][:10])
@@ -1,11 +1,14 @@
 # coding: utf-8
 from aiohttp_requests import requests
 
-API_FORMAT = "https://www.api-couleur-tempo.fr/api/{endpoint}"
+import config
+
+TEMPO_ROOT = "https://www.api-couleur-tempo.fr"
+API_FORMAT = "{root}/api/{endpoint}"
 
 
 async def get_days(days: list[str]) -> list[dict]:
-    url = API_FORMAT.format(endpoint="joursTempo")
+    url = API_FORMAT.format(root=config.config.get("TEMPO_API_ROOT") or TEMPO_ROOT, endpoint="joursTempo")
     req = await requests.get(url, params={"dateJour[]": days})
     req.raise_for_status()
     res = await req.json()
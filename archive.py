@@ -0,0 +1,82 @@
+# coding: utf-8
+import functools
+import json
+import sqlite3
+import zlib
+from calendar import monthrange
+from datetime import date
+from typing import Optional
+
+import numpy as np
+
+# marks slices without a reading in packed months
+MISSING = -1
+
+
+def pack(values: np.ndarray) -> bytes:
+    """
+    Compresses the raw values of a month (`MISSING` for absent slices). The bytes of the int32 values are shuffled so
+    that the mostly-zero high bytes end up next to each other, which zlib compresses much better.
+    """
+    return zlib.compress(np.ascontiguousarray(values, dtype="<i4").view(np.uint8).reshape(-1, 4).T.tobytes(), 9)
+
+
+@functools.lru_cache(maxsize=64)
+def unpack(data: bytes) -> np.ndarray:
+    """
+    Gives the raw values of a packed month, as a read-only array of days_in_month * 48 int32.
+    """
+    raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    values = raw.reshape(4, -1).T.copy().view("<i4").reshape(-1)
+    values.flags.writeable = False
+    return values
+
+
+def register(conn: sqlite3.Connection):
+    """
+    Registers the functions the `consumption_all` view needs. Must be called on every connection that queries it.
+    """
+    conn.create_function("archive_json", 1, lambda data: json.dumps(unpack(data).tolist()), deterministic=True)
+
+
+def stored_days(cur: sqlite3.Cursor) -> Optional[tuple[date, date]]:
+    """
+    Gives the first and last days that have readings in either tier, or None if there are none.
+    """
+    days = []
+    for order in ("ASC", "DESC"):
+        row = cur.execute(f"SELECT year, month, day FROM consumption ORDER BY year {order}, month {order}, day {order} "
+                          f"LIMIT 1").fetchone()
+        if row is not None:
+            days.append(date(*row))
+        row = cur.execute(f"SELECT year, month, data FROM consumption_archive ORDER BY year {order}, month {order} "
+                          f"LIMIT 1").fetchone()
+        if row is not None:
+            present = np.flatnonzero(unpack(row[2]) != MISSING) // 48 + 1
+            if len(present):
+                days.append(date(row[0], row[1], int(present[0 if order == "ASC" else -1])))
+    return (min(days), max(days)) if days else None
+
+
+def compact(conn: sqlite3.Connection, before: date) -> int:
+    """
+    Moves the months of `consumption` that end before `before` to `consumption_archive`, merging them with what's
+    already archived for the same month. Gives the number of months archived.
+    """
+    months = conn.execute("SELECT DISTINCT year, month FROM consumption WHERE (year, month) < (?, ?)",
+                          (before.year, before.month)).fetchall()
+    for year, month in months:
+        archived = conn.execute("SELECT data FROM consumption_archive WHERE year = ? AND month = ?",
+                                (year, month)).fetchone()
+        if archived is not None:
+            values = unpack(archived[0]).copy()
+        else:
+            values = np.full(monthrange(year, month)[1] * 48, MISSING, dtype=np.int32)
+        rows = np.array(conn.execute("SELECT day, slice, value FROM consumption WHERE year = ? AND month = ?",
+                                     (year, month)).fetchall(), dtype=np.int64).reshape(-1, 3)
+        values[(rows[:, 0] - 1) * 48 + rows[:, 1]] = rows[:, 2]
+        conn.execute("INSERT OR REPLACE INTO consumption_archive (year, month, data) VALUES (?, ?, ?)",
+                     (year, month, pack(values)))
+        conn.execute("DELETE FROM consumption WHERE year = ? AND month = ?", (year, month))
+    conn.commit()
+    return len(months)
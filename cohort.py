@@ -0,0 +1,246 @@
+# coding: utf-8
+import argparse
+import asyncio
+import bisect
+import functools
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from edf_plan import EdfPlan
+from report import fresh_processes, meter_directory
+
+# Where households stand among similar ones. Each meter is reduced to a few features over its last year, and the
+# features of the meters of a cohort (same subscribed power, and same plan when known) are summarized by their
+# percentiles, so that ranking a meter takes a binary search in a table of fixed size.
+
+FEATURES = {
+    "annual_kwh": "consommation annuelle",
+    "baseload": "consommation de base",
+    "hp_share": "part en heures pleines",
+    "red_day_kwh": "consommation par jour rouge",
+}
+
+# percentiles stored for each feature of each cohort
+QUANTILES = np.linspace(0, 1, 101)
+
+# meters needed for a cohort to be ranked against
+MIN_COHORT = 5
+
+# days of history needed to compute the features of a meter
+MIN_DAYS = 30
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("meters", nargs="+",
+                        help="app.db files or directories containing app.db and .env (or meter ids, with --root)")
+    parser.add_argument("--root", type=Path, help="directory containing one subdirectory per meter id")
+    parser.add_argument("--index", "-o", type=Path, default=Path("cohort.json"),
+                        help="index file, updated for the meters whose data changed since it was written")
+    parser.add_argument("--workers", type=int, default=None, help="number of meters processed at once")
+
+
+def features(hist) -> Optional[dict]:
+    """
+    Gives the features of `hist` (a `history.History` of the last year, see `last_year`), None where they can't be
+    computed, and the plan that is the cheapest at the current rates. Returns None if there are less than `MIN_DAYS`
+    complete days.
+    """
+    import analytics
+    import pricing
+
+    complete = ~np.isnan(hist.values).any(axis=1)
+    if np.count_nonzero(complete) < MIN_DAYS:
+        return None
+    known = np.count_nonzero(~np.isnan(hist.values))
+    total = np.nansum(hist.values)
+    stats = analytics.compute(hist)
+    hp = EdfPlan.HPHC.hp_slices()
+    costs = {plan: pricing.total_cost(pricing.slice_costs(plan, hist, "current")) for plan in EdfPlan}
+    costs = {plan: cost for plan, cost in costs.items() if not math.isinf(cost)}
+    return {
+        # extrapolated to a whole year from the slices that have data
+        "annual_kwh": float(total / known * 48 * 365 / 1000),
+        "baseload": None if math.isnan(stats.baseload) else stats.baseload,
+        "hp_share": float(np.nansum(hist.values[:, hp]) / total) if total else None,
+        "red_day_kwh": float(stats.tempo_energy[2] / stats.tempo_days[2] / 1000) if stats.tempo_days[2] else None,
+        "cheapest": min(costs, key=costs.get).value if costs else None,
+    }
+
+
+def last_year():
+    """
+    Loads the last year of stored consumption.
+    """
+    import archive
+    import db
+    import history
+    from datetime import timedelta
+
+    stored = archive.stored_days(db.cur)
+    if stored is None:
+        return history.load_history()
+    return history.load_history(start=max(stored[0], stored[1] - timedelta(days=364)), end=stored[1])
+
+
+def _meter_features(directory: str) -> dict:
+    """
+    Runs in a fresh worker process, for the same reasons as `report._report_meter`.
+    """
+    os.chdir(directory)
+    import config
+    config.load()
+
+    import db
+    asyncio.run(db.load_meter_info())
+    plan = config.config.get("CURRENT_PLAN")
+    return {
+        "version": db.data_version(),
+        "power": db.sub_power,
+        "plan": EdfPlan(plan).value if plan else None,
+        "features": features(last_year()),
+    }
+
+
+def data_version(directory: str) -> Optional[int]:
+    """
+    Reads the data version of the meter database in `directory` without opening it for writing, None if it can't be
+    read (such as before the database was first set up).
+    """
+    try:
+        conn = sqlite3.connect(f"file:{Path(directory) / 'app.db'}?mode=ro", uri=True)
+        try:
+            res = conn.execute("SELECT value FROM config WHERE key = 'data_version'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return 0 if res is None else int(res[0])
+
+
+def cohort_keys(power: int, plan: Optional[str]) -> list[str]:
+    """
+    Gives the keys of the cohorts a meter belongs to, the most specific first.
+    """
+    return [f"{power}/{plan}", str(power)] if plan else [str(power)]
+
+
+def build_cohorts(meters: dict[str, dict]) -> dict[str, dict]:
+    """
+    Summarizes the features of the meters of each cohort by their percentiles.
+    """
+    members = {}
+    for meter in meters.values():
+        if meter["features"] is not None:
+            for key in cohort_keys(meter["power"], meter["plan"]):
+                members.setdefault(key, []).append(meter["features"])
+    cohorts = {}
+    for key, rows in sorted(members.items()):
+        percentiles = {}
+        for feature in FEATURES:
+            # None (unknown) becomes NaN
+            values = np.array([row[feature] for row in rows], dtype=float)
+            values = values[~np.isnan(values)]
+            if len(values) >= MIN_COHORT:
+                percentiles[feature] = np.quantile(values, QUANTILES).tolist()
+        cheapest = [row["cheapest"] for row in rows if row["cheapest"] is not None]
+        cohorts[key] = {
+            "count": len(rows),
+            "percentiles": percentiles,
+            "cheapest": {plan: cheapest.count(plan) / len(cheapest) for plan in sorted(set(cheapest))},
+        }
+    return cohorts
+
+
+def percentile_rank(table: list[float], value: float) -> float:
+    """
+    Gives the share (0 to 1) of the cohort below `value`, from the percentiles of a feature, interpolating between
+    them.
+    """
+    i = bisect.bisect_left(table, value)
+    if i == 0:
+        return 0.0
+    if i == len(table):
+        return 1.0
+    lo, hi = table[i - 1], table[i]
+    return float(QUANTILES[i - 1] + (QUANTILES[i] - QUANTILES[i - 1]) * ((value - lo) / (hi - lo) if hi > lo else 1))
+
+
+def rank(index: dict, power: int, plan: Optional[str], meter_features: dict) -> Optional[tuple[str, dict]]:
+    """
+    Ranks a meter in the most specific cohort of `index` it belongs to that has enough members. Gives the cohort key
+    and the rank (0 to 1) of each feature that could be ranked, None if no cohort fits.
+    """
+    for key in cohort_keys(power, plan):
+        cohort = index["cohorts"].get(key)
+        if cohort is None or not cohort["percentiles"]:
+            continue
+        return key, {feature: percentile_rank(table, meter_features[feature])
+                     for feature, table in cohort["percentiles"].items()
+                     if meter_features[feature] is not None}
+    return None
+
+
+def cohort_name(key: str) -> str:
+    power, _, plan = key.partition("/")
+    return f"foyers {power} kVA" + (f" {EdfPlan(plan).display_name()}" if plan else "")
+
+
+@functools.lru_cache(maxsize=1)
+def _load_index(path: str, mtime: int) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_index(path) -> Optional[dict]:
+    """
+    Gives the index at `path`, read again only when the file changes. None if there is none.
+    """
+    try:
+        return _load_index(str(path), os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def run(args: argparse.Namespace):
+    directories = {}
+    for meter in args.meters:
+        try:
+            directory = str(meter_directory(meter, args.root))
+            directories[Path(directory).name] = directory
+        except (ValueError, FileNotFoundError) as e:
+            print(e, file=sys.stderr)
+
+    index = load_index(args.index) or {"meters": {}, "cohorts": {}}
+    # meters that aren't given anymore are dropped
+    meters = {name: index["meters"][name] for name in directories if name in index["meters"]}
+    # meters whose data didn't change keep their features
+    stale = [name for name, directory in directories.items()
+             if name not in meters or data_version(directory) != meters[name]["version"]]
+
+    start = time.perf_counter()
+    failed = 0
+    for name, future in fresh_processes(_meter_features, {name: (directories[name],) for name in stale}, args.workers):
+        try:
+            meters[name] = future.result()
+        except Exception as e:
+            failed += 1
+            meters.pop(name, None)
+            print(name, e, file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    index = {"meters": meters, "cohorts": build_cohorts(meters)}
+    temporary = args.index.with_name(args.index.name + ".tmp")
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1)
+    os.replace(temporary, args.index)
+
+    print(f"{len(stale) - failed} meters updated, {len(directories) - len(stale)} unchanged, {failed} failed, in "
+          f"{elapsed:.1f} s; {len(index['cohorts'])} cohorts written to {args.index}")
@@ -0,0 +1,25 @@
+# coding: utf-8
+from typing import Any, Callable, Hashable
+
+import db
+
+_version = None
+_entries: dict[Hashable, Any] = {}
+
+
+def cached(key: Hashable, compute: Callable[[], Any]) -> Any:
+    """
+    Gives the result of `compute` for `key`, computed at most once per data version and shared by every client.
+
+    Everything is dropped when the data version changes. Page handlers run on the event loop, one at a time, so
+    clients asking for the same key right after a change wait for a single computation instead of each running their
+    own. Results are shared and must not be modified.
+    """
+    global _version
+    version = db.data_version()
+    if version != _version:
+        _entries.clear()
+        _version = version
+    if key not in _entries:
+        _entries[key] = compute()
+    return _entries[key]
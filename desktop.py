@@ -2,7 +2,7 @@
 import asyncio
 
 import nicegui.events
-from nicegui import native, ui as nui, run as nrun
+from nicegui import native, ui as nui, run as nrun, background_tasks
 import webbrowser
 import platformdirs
 from starlette.responses import RedirectResponse
@@ -62,7 +62,7 @@ def loading():
     fetch_edf.log_callback = logger
     nui.markdown("# Récupération des données")
     log_display()
-    task = asyncio.create_task(fetch_edf.fetch_loop())
+    task = asyncio.create_task(fetch_edf.fetch_loop(progressive=True))
     import ui
     _ = ui
     done = False
@@ -71,6 +71,8 @@ def loading():
         if not done and task.done():
             nui.open("/app")
             done = True
+            # the load curve fills in behind, the open pages updating as it comes
+            background_tasks.create(fetch_edf.fetch_apis())
     nui.timer(0.1, timer_callback)
 
 @nui.page("/")
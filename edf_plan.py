@@ -1,8 +1,10 @@
 # coding: utf-8
+import datetime
 import enum
+import functools
 from typing import Optional
 
-from db import sub_power
+import numpy as np
 
 
 class EdfPlan(enum.Enum):
@@ -69,10 +71,100 @@ class EdfPlan(enum.Enum):
             case _:
                 return None
 
+    def day_kind_count(self) -> int:
+        """
+        Gives the number of day kinds `day_kind_sql` distinguishes, 1 if the plan doesn't differentiate them.
+        """
+        match self:
+            case EdfPlan.TEMPO:
+                return 3
+            case EdfPlan.ZENFLEX | EdfPlan.ZENWEEKEND | EdfPlan.ZENWEEKENDHC:
+                return 2
+            case _:
+                return 1
+
+    def hp_slices(self) -> Optional[np.ndarray]:
+        """
+        Gives a boolean array of shape (48,) that is true for the slices in the HP period. Counterpart of `is_hp_sql`.
+
+        If the plan doesn't differentiate HC/HP, returns None.
+        """
+        hour = np.arange(48) // 2
+        match self:
+            case EdfPlan.HPHC | EdfPlan.TEMPO | EdfPlan.ZENWEEKENDHC | EdfPlan.TOTALSTDFIXEHC:
+                return (6 <= hour) & (hour < 22)
+            case EdfPlan.ZENFLEX:
+                return (8 <= hour) & (hour < 13) | (18 <= hour) & (hour < 20)
+            case _:
+                return None
+
+    def day_kinds(self, days: np.ndarray, tempo: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Gives an (n, 48) array of the day kind of each slice (0 when unknown). Counterpart of `day_kind_sql`.
+
+        `days` is a datetime64[D] array of n consecutive days and `tempo` holds the n + 1 Tempo colours starting the
+        day before `days[0]`, as laid out in `history.History`.
+
+        If the plan doesn't differentiate day kinds, returns None.
+        """
+        match self:
+            case EdfPlan.TEMPO:
+                return np.where(np.arange(48) < 12, tempo[:-1, None], tempo[1:, None])
+            case EdfPlan.ZENFLEX:
+                kinds = np.select([tempo[1:] == 3, tempo[1:] != 0], [2, 1], 0)
+            case EdfPlan.ZENWEEKEND | EdfPlan.ZENWEEKENDHC:
+                # 1970-01-01 was a Thursday
+                kinds = np.where((days.astype(np.int64) + 3) % 7 >= 5, 2, 1)
+            case _:
+                return None
+        return np.broadcast_to(kinds[:, None], (len(days), 48))
+
+    def tempo_offsets(self) -> Optional[np.ndarray]:
+        """
+        Gives an int array of shape (48,) of the index, relative to the day of each slice, of the `tempo` entry (as laid
+        out in `day_kinds`) its day kind depends on: 0 for the colour of the day before, 1 for the day's own.
+
+        If the plan's day kinds don't depend on the Tempo colours, returns None.
+        """
+        match self:
+            case EdfPlan.TEMPO:
+                return np.where(np.arange(48) < 12, 0, 1)
+            case EdfPlan.ZENFLEX:
+                return np.ones(48, dtype=np.int64)
+            case _:
+                return None
+
 
-def query_plan_stats(plans: list[EdfPlan] = EdfPlan) -> str:
+# restricts raw consumption rows to the bound date range; the (year, month) part lets both storage tiers use their
+# primary key
+DATE_RANGE_FILTER = "(c.year, c.month) BETWEEN (:start_year, :start_month) AND (:end_year, :end_month) " \
+                    "AND (c.year, c.month, c.day) BETWEEN (:start_year, :start_month, :start_day) " \
+                    "AND (:end_year, :end_month, :end_day)"
+
+
+def query_params(start: Optional[datetime.date] = None, end: Optional[datetime.date] = None,
+                 power: Optional[int] = None) -> dict:
+    """
+    Gives the parameters to bind to the statements built by the `query_plan_*` functions: the date range (inclusive,
+    unbounded by default) and the subscribed power (the current meter's by default).
     """
-    Gives an SQL statement that returns the consumption stats with the following columns:
+    if power is None:
+        import db
+        power = db.sub_power
+    start = start or datetime.date.min
+    end = end or datetime.date.max
+    return {
+        "power": power,
+        "start_year": start.year, "start_month": start.month, "start_day": start.day,
+        "end_year": end.year, "end_month": end.month, "end_day": end.day,
+    }
+
+
+def query_plan_stats(plans: list[EdfPlan] = EdfPlan, source: str = "consumption_all") -> str:
+    """
+    Gives an SQL statement that returns the consumption stats of the rows of `source` (both storage tiers by default,
+    `consumption_approx` to fill the days without a load curve with estimates) within the bound date range with the
+    following columns:
     - hp_{plan}: 1 if the current hour is in the HP period for {plan}
     - day_{plan}: the day kind for {plan}
     - date: YYYY-MM-DD
@@ -87,16 +179,18 @@ def query_plan_stats(plans: list[EdfPlan] = EdfPlan) -> str:
     hour,
     c.slice,
     c.value / 2 as value
-    FROM consumption c"""
+    FROM """ + source + " c WHERE " + DATE_RANGE_FILTER
 
 
-def query_plan_prices_bihourly(plans: list[EdfPlan] = EdfPlan, price_mode = "real") -> str:
+def query_plan_prices_bihourly(plans: list[EdfPlan] = EdfPlan, price_mode = "real", source: str = "consumption_all") -> str:
     """
     Gives an SQL statement that returns the summarized consumption stats for each 30min slice with the following columns:
     - date: YYYY-MM-DD
     - slice: slice index (0-47)
     - value: consumption in Wh
     - eur_{plan}: cost in € for {plan}
+
+    The statement expects the parameters given by `query_params`.
     """
     match price_mode:
         case "real":
@@ -111,9 +205,9 @@ def query_plan_prices_bihourly(plans: list[EdfPlan] = EdfPlan, price_mode = "rea
                 iif(hp_{p.value}, kwh_hp, kwh_hc) * c.value + 
                 subscription * 100000 / 12 / cast(JULIANDAY(date, '+1 month') - JULIANDAY(date) as integer) / 48
             from edf_plan_slice s
-            where plan_id='{p.value}' and power = {sub_power} and day_kind = day_{p.value}
+            where plan_id='{p.value}' and power = :power and day_kind = day_{p.value}
             {price_query}), 1e999) as eur_{p.value}""" for p in plans
-    ]) + f" FROM ({query_plan_stats(plans)}) c"
+    ]) + f" FROM ({query_plan_stats(plans, source)}) c"
 
 
 def query_plan_prices_monthly(plans: list[EdfPlan] = EdfPlan) -> str:
@@ -123,19 +217,30 @@ def query_plan_prices_monthly(plans: list[EdfPlan] = EdfPlan) -> str:
     - value: consumption in Wh
     - eur_{plan}: cost in € for {plan}
     """
-    return query_plan_prices_period(plans, date="strftime('%Y-%m', c.date)", filter="1")
+    return query_plan_prices_period(plans, date="strftime('%Y-%m', c.date)")
 
 
-def query_plan_prices_period(plans: list[EdfPlan] = EdfPlan, price_mode="real", date: str = "c.date", filter: str = "1", with_total: bool = False) -> str:
+def query_plan_prices_period(plans: list[EdfPlan] = EdfPlan, price_mode="real", date: str = "c.date", with_total: bool = False,
+                             source: str = "consumption_all") -> str:
     """
     Gives an SQL statement that returns the summarized consumption stats for each day with the following columns:
     - date: YYYY-MM-DD
     - value: consumption in Wh
     - eur_{plan}: cost in € for {plan}
+
+    The statement expects the parameters given by `query_params`. Its text only depends on the arguments, which are
+    few in practice, so it is built once per combination and then reused from sqlite3's per-connection statement cache
+    without being parsed and planned again.
     """
+    return _query_plan_prices_period(tuple(plans), price_mode, date, with_total, source)
+
+
+@functools.lru_cache(maxsize=64)
+def _query_plan_prices_period(plans: tuple[EdfPlan, ...], price_mode: str, date: str, with_total: bool,
+                              source: str) -> str:
     query = f"SELECT {date}, sum(c.value) as value, " + ",".join([
         f"SUM(eur_{p.value}) as eur_{p.value}" for p in plans
-    ]) + f" FROM ({query_plan_prices_bihourly(plans, price_mode)}) c WHERE {filter} GROUP BY {date}"
+    ]) + f" FROM ({query_plan_prices_bihourly(plans, price_mode, source)}) c GROUP BY {date}"
     if with_total:
         return f"""
         WITH prices AS ({query}) 
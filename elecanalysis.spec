@@ -7,7 +7,7 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[(str(Path(nicegui.__file__).parent), 'nicegui')],
+    datas=[(str(Path(nicegui.__file__).parent), 'nicegui'), ('tariffs.json', '.')],
     hiddenimports=['socketio'],
     hookspath=[],
     hooksconfig={},
@@ -1,20 +1,94 @@
 # coding: utf-8
 import asyncio
 import io
-import itertools
+import json
+import time
+from dataclasses import dataclass
 from datetime import date, timedelta, datetime
 from decimal import Decimal
+from typing import Callable, Optional
 
 import aiohttp
 import pandas as pd
 import requests
 
+import aggregates
+import archive
+import maintenance
+import profiling
+import tariffs
 from apis import myelectricaldata, tempo, datagouvfr
-from db import cur, db, activation_date
-from edf_plan import EdfPlan
+from config import config
+from db import cur, db, activation_date, bump_data_version
 
 log_callback = print
 
+
+@dataclass
+class DataChange:
+    """
+    Describes data written by ingestion: the table that changed and the range of days (inclusive) it changed for.
+    """
+    table: str
+    start: date
+    end: date
+
+    def overlaps(self, start: Optional[date], end: Optional[date]) -> bool:
+        """
+        Gives whether the change affects days between `start` and `end` (inclusive, None meaning unbounded).
+        """
+        return (start is None or self.end >= start) and (end is None or self.start <= end)
+
+
+# seconds between two notifications of the changes a fetch is still making
+NOTIFY_INTERVAL = 5
+
+# called with each DataChange, once it is committed
+change_callbacks: list[Callable[[DataChange], None]] = []
+
+
+def notify_change(change: DataChange):
+    for callback in change_callbacks:
+        callback(change)
+
+
+class ChangeBatch:
+    """
+    Merges the changes a fetch makes to `table`, window after window, into a single range that is notified at most
+    every `NOTIFY_INTERVAL` seconds and when the batch is left, so that a long backfill doesn't make the open pages
+    recompute after each window.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.start = self.end = None
+        # the first changes are notified right away
+        self.notified = time.monotonic() - NOTIFY_INTERVAL
+
+    def add(self, start: date, end: date):
+        """
+        Adds committed changes.
+        """
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+        if time.monotonic() - self.notified >= NOTIFY_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.start is not None:
+            notify_change(DataChange(self.table, self.start, self.end))
+            self.start = self.end = None
+        self.notified = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+
+@profiling.profiled
 async def fetch_enedis(upto=None):
     """
     Fetches the consumption data from Enedis using the MyElectricalData API.
@@ -24,42 +98,97 @@ async def fetch_enedis(upto=None):
     """
     start_date = None
 
-    try:
-        last_info = date(*map(int, cur.execute(
-            "SELECT year, month, day FROM consumption ORDER BY year DESC, month DESC, day DESC LIMIT 1").fetchone()))
-    except TypeError:
-        last_info = activation_date - timedelta(days=1)
+    stored = archive.stored_days(cur)
+    last_info = stored[1] if stored is not None else activation_date - timedelta(days=1)
 
     last_info = max(date.today() - timedelta(days=2 * 365), last_info)
 
-    while True:
-        # last info is max ymd from db
-        new_start_date = last_info + timedelta(days=1)
-        if new_start_date == start_date or new_start_date >= date.today():
-            break
-        start_date = new_start_date
-        end_date = start_date + timedelta(days=7)
-        try:
-            log_callback("Fetching MED for", str(start_date), "to", str(end_date))
-            conso_data = (await myelectricaldata.fetch_api("consumption_load_curve", (start_date, end_date)))[
-                "meter_reading"]["interval_reading"]
-        except aiohttp.ClientResponseError as e:
-            log_callback(e)
-            break
-        log_callback("Saving", len(conso_data), "Enedis rows")
-        for reading in conso_data:
-            dt = datetime.fromisoformat(reading["date"]) - timedelta(minutes=30)
-
-            slice_idx = dt.hour * 2 + dt.minute // 30
-
-            if dt.date() > last_info:
-                last_info = dt.date()
-
-            cur.execute("INSERT OR REPLACE INTO consumption VALUES (?, ?, ?, ?, ?)",
-                        (dt.year, dt.month, dt.day, slice_idx, int(reading["value"])))
-        db.commit()
+    with ChangeBatch("consumption") as changes:
+        while True:
+            # last info is max ymd from db
+            new_start_date = last_info + timedelta(days=1)
+            if new_start_date == start_date or new_start_date >= date.today():
+                break
+            start_date = new_start_date
+            end_date = start_date + timedelta(days=7)
+            try:
+                log_callback("Fetching MED for", str(start_date), "to", str(end_date))
+                conso_data = (await myelectricaldata.fetch_api("consumption_load_curve", (start_date, end_date)))[
+                    "meter_reading"]["interval_reading"]
+            except aiohttp.ClientResponseError as e:
+                log_callback(e)
+                break
+            log_callback("Saving", len(conso_data), "Enedis rows")
+            written = []
+            aggregator = aggregates.Aggregator()
+            for reading in conso_data:
+                dt = datetime.fromisoformat(reading["date"]) - timedelta(minutes=30)
+                written.append(dt.date())
+
+                slice_idx = dt.hour * 2 + dt.minute // 30
+
+                if dt.date() > last_info:
+                    last_info = dt.date()
+
+                key = (dt.year, dt.month, dt.day, slice_idx)
+                old = cur.execute("SELECT value FROM consumption WHERE year = ? AND month = ? AND day = ? AND slice = ?",
+                                  key).fetchone()
+                cur.execute("INSERT OR REPLACE INTO consumption VALUES (?, ?, ?, ?, ?)", (*key, int(reading["value"])))
+                aggregator.add(dt.date(), slice_idx, int(reading["value"]), old and old[0])
+            aggregator.flush(cur)
+            if conso_data:
+                bump_data_version()
+            db.commit()
+            if written:
+                changes.add(min(written), max(written))
+
 
+@profiling.profiled
+async def fetch_enedis_daily():
+    """
+    Fetches the daily consumption and peak power from Enedis using the MyElectricalData API.
 
+    A year is retrieved at a time, so the whole history only takes a handful of requests. The views use these to show
+    approximate figures for the days the load curve doesn't cover yet.
+    """
+    last = cur.execute("SELECT year, month, day FROM consumption_daily "
+                       "ORDER BY year DESC, month DESC, day DESC LIMIT 1").fetchone()
+    start_date = date(*last) + timedelta(days=1) if last is not None else activation_date
+    # Enedis keeps three years of daily data
+    start_date = max(date.today() - timedelta(days=3 * 365), start_date)
+
+    with ChangeBatch("consumption_daily") as changes:
+        while start_date < date.today():
+            end_date = min(start_date + timedelta(days=365), date.today())
+            try:
+                log_callback("Fetching MED daily for", str(start_date), "to", str(end_date))
+                energy_data = (await myelectricaldata.fetch_api("daily_consumption", (start_date, end_date)))[
+                    "meter_reading"]["interval_reading"]
+                peak_data = (await myelectricaldata.fetch_api("daily_consumption_max_power", (start_date, end_date)))[
+                    "meter_reading"]["interval_reading"]
+            except aiohttp.ClientResponseError as e:
+                log_callback(e)
+                break
+            log_callback("Saving", len(energy_data), "daily rows")
+            peaks = {reading["date"][:10]: reading for reading in peak_data}
+            written = []
+            for reading in energy_data:
+                day = date.fromisoformat(reading["date"][:10])
+                written.append(day)
+                peak = peaks.get(reading["date"][:10])
+                cur.execute("INSERT OR REPLACE INTO consumption_daily VALUES (?, ?, ?, ?, ?, ?)",
+                            (day.year, day.month, day.day, int(reading["value"]),
+                             int(peak["value"]) if peak is not None else None,
+                             peak["date"][11:16] if peak is not None else None))
+            if written:
+                bump_data_version()
+            db.commit()
+            if written:
+                changes.add(min(written), max(written))
+            start_date = end_date
+
+
+@profiling.profiled
 async def fetch_tempo():
     """
     Fetches the Tempo data from the api-couleur-tempo.fr API.
@@ -82,46 +211,40 @@ async def fetch_tempo():
 
     last_info = max(date.today() - timedelta(days=2 * 365 + 1), last_info)
 
-    while True:
-        # last info is max ymd from db
-        new_start_date = last_info + timedelta(days=1)
-        if new_start_date == start_date or new_start_date >= date.today():
-            break
-        start_date = new_start_date
-        try:
-            tempo_data = await tempo.get_days([str(start_date + timedelta(days=i)) for i in range(100)])
-        except aiohttp.ClientResponseError as e:
-            log_callback(e)
-            break
-
-        log_callback("Saving", len(tempo_data), "Tempo rows")
-        for reading in tempo_data:
-            dt = date.fromisoformat(reading["dateJour"])
-            val = reading["codeJour"]
-
-            if val != 0:
-                cur.execute("INSERT OR REPLACE INTO tempo VALUES (?, ?, ?, ?)",
-                            (dt.year, dt.month, dt.day, val))
-
-                if dt > last_info:
-                    last_info = dt
-        db.commit()
-
-
-# polyfill for Python <3.12
-if not hasattr(itertools, "batched"):
-    def batched(iterable, n):
-        it = iter(iterable)
+    with ChangeBatch("tempo") as changes:
         while True:
-            chunk = tuple(itertools.islice(it, n))
-            if not chunk:
-                return
-            yield chunk
-
-
-    setattr(itertools, "batched", batched)
+            # last info is max ymd from db
+            new_start_date = last_info + timedelta(days=1)
+            if new_start_date == start_date or new_start_date >= date.today():
+                break
+            start_date = new_start_date
+            try:
+                tempo_data = await tempo.get_days([str(start_date + timedelta(days=i)) for i in range(100)])
+            except aiohttp.ClientResponseError as e:
+                log_callback(e)
+                break
+
+            log_callback("Saving", len(tempo_data), "Tempo rows")
+            written = []
+            for reading in tempo_data:
+                dt = date.fromisoformat(reading["dateJour"])
+                val = reading["codeJour"]
+
+                if val != 0:
+                    cur.execute("INSERT OR REPLACE INTO tempo VALUES (?, ?, ?, ?)",
+                                (dt.year, dt.month, dt.day, val))
+                    written.append(dt)
+
+                    if dt > last_info:
+                        last_info = dt
+            if tempo_data:
+                bump_data_version()
+            db.commit()
+            if written:
+                changes.add(min(written), max(written))
 
 
+@profiling.profiled
 async def fetch_prices():
     """
     Fetches the prices for Base and Bleu from data.gouv.fr and inserts them in the database.
@@ -129,8 +252,7 @@ async def fetch_prices():
     The datasets are in CSV format and contain both the yearly subscription price and the price per kWh for each
     pricing period.
     """
-    for name, rid in (
-            ("base", "c13d05e5-9e55-4d03-bf7e-042a2ade7e49"), ("hphc", "f7303b3a-93c7-4242-813d-84919034c416")):
+    for name, rid in datagouvfr.TARIFF_RESOURCES.items():
         existing = cur.execute(f"SELECT value FROM config WHERE key = 'tarif_{name}'").fetchone()
         if existing is None:
             update = True
@@ -165,207 +287,106 @@ async def fetch_prices():
                              dec_to_fixed(row["PART_VARIABLE_HC_TTC"], 4), dmy_to_iso(row["DATE_FIN"])))
 
             log_callback("Updated tariff", name)
+            bump_data_version()
             cur.execute(f"INSERT OR REPLACE INTO config VALUES ('tarif_{name}', ?)", (date.today().isoformat(),))
             db.commit()
+            notify_change(DataChange("edf_plan_slice", date.min, date.max))
 
 def add_prices_pdf():
     """
-    Some prices aren't provided by any API, so we have to get them from the public PDF price sheets. One day, this will
-    maybe download the files and try and extract the tables from them, but for now, it's just a hardcoded dict.
-
-    Since the prices are laid out in tables, it's easy to copy and paste the data from a PDF file to here.
+    Some prices aren't provided by any API, so we have to get them from the public PDF price sheets, copied to the
+    tariff bundle (see `tariffs`). The bundle is only loaded when its content changed since the last time, and only
+    the rows that differ are written.
     """
+    path = config.get("TARIFF_BUNDLE") or tariffs.BUNDLE_PATH
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except OSError as e:
+        log_callback("Cannot read tariff bundle", path, repr(e))
+        return
+    digest = tariffs.bundle_hash(content)
+    existing = cur.execute("SELECT value FROM config WHERE key = 'tariff_bundle_hash'").fetchone()
+    if existing is not None and existing[0] == digest:
+        return
+
+    try:
+        rows = tariffs.parse_bundle(json.loads(content))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        log_callback("Invalid tariff bundle", path, repr(e))
+        return
+    added, changed, removed = tariffs.diff(cur, rows)
+    log_callback("Tariff bundle:", len(added), "added,", len(changed), "changed,", len(removed), "removed")
+    for key in sorted(changed):
+        log_callback("  changed", *key)
+    for key in sorted(removed):
+        log_callback("  removed", *key)
+
+    tariffs.apply(cur, added | changed, removed)
+    if added or changed or removed:
+        bump_data_version()
+    cur.execute("INSERT OR REPLACE INTO config VALUES ('tariff_bundle_hash', ?)", (digest,))
+    db.commit()
+    if added or changed or removed:
+        notify_change(DataChange("edf_plan_slice", date.min, date.max))
+
 
-    # https://particulier.edf.fr/content/dam/2-Actifs/Documents/Offres/Grille_prix_Tarif_Bleu.pdf
-    # https://particulier.edf.fr/content/dam/2-Actifs/Documents/Offres/Grille-prix-zen-flex.pdf
-    # https://particulier.edf.fr/content/dam/2-Actifs/Documents/Offres/grille-prix-zen-week-end.pdf
-
-    edf_pdf_data = {
-        "tempo": {
-            "2023-01-01": """
-6 12,28 9,70 12,49 11,40 15,08 12,16 67,12
-9 15,33 9,70 12,49 11,40 15,08 12,16 67,12
-12 18,78 9,70 12,49 11,40 15,08 12,16 67,12
-15 21,27 9,70 12,49 11,40 15,08 12,16 67,12
-18 23,98 9,70 12,49 11,40 15,08 12,16 67,12
-30 36,06 9,70 12,49 11,40 15,08 12,16 67,12
-36 41,90 9,70 12,49 11,40 15,08 12,16 67,12
-    """,
-            "2023-08-01": """
-6 12,80 10,56 13,69 12,46 16,54 13,28 73,24
-9 16,00 10,56 13,69 12,46 16,54 13,28 73,24
-12 19,29 10,56 13,69 12,46 16,54 13,28 73,24
-15 22,30 10,56 13,69 12,46 16,54 13,28 73,24
-18 25,29 10,56 13,69 12,46 16,54 13,28 73,24
-30 38,13 10,56 13,69 12,46 16,54 13,28 73,24
-36 44,28 10,56 13,69 12,46 16,54 13,28 73,24
-    """,
-            "2024-02-01": """
-6 12,96 12,96 16,09 14,86 18,94 15,68 75,62
-9 16,16 12,96 16,09 14,86 18,94 15,68 75,62
-12 19,44 12,96 16,09 14,86 18,94 15,68 75,62
-15 22,45 12,96 16,09 14,86 18,94 15,68 75,62
-18 25,44 12,96 16,09 14,86 18,94 15,68 75,62
-30 38,29 12,96 16,09 14,86 18,94 15,68 75,62
-36 44,42 12,96 16,09 14,86 18,94 15,68 75,62
+def compact_consumption():
     """
-        }, # TODO: corriger quand les chiffres officiels sortent
-#         "hphc": {
-#             "2024-02-01": """
-# 6 13,01 20,68 27,00
-# 9 16,70 20,68 27,00
-# 12 20,13 20,68 27,00
-# 15 23,40 20,68 27,00
-# 18 26,64 20,68 27,00
-# 24 33,44 20,68 27,00
-# 30 39,63 20,68 27,00
-# 36 44,79 20,68 27,00
-#     """
-#         },
-#         "base": {
-#             "2024-02-01": """
-# 3 9,63 25,16
-# 6 12,60 25,16
-# 9 15,79 25,16
-# 12 19,04 25,16
-# 15 22,07 25,16
-# 18 25,09 25,16
-# 24 31,76 25,16
-# 30 37,44 25,16
-# 36 44,82 25,16
-#     """
-#         },
-        "zenflex": {
-            "2023-08-01": """
-6 12,62 12,95 22,28 22,28 67,12
-9 15,99 12,95 22,28 22,28 67,12
-12 19,27 12,95 22,28 22,28 67,12
-15 22,40 12,95 22,28 22,28 67,12
-18 25,46 12,95 22,28 22,28 67,12
-24 32,01 12,95 22,28 22,28 67,12
-30 38,07 12,95 22,28 22,28 67,12
-36 43,88 12,95 22,28 22,28 67,12
-    """,
-            "2023-09-14": """
-6 13,03 14,64 24,60 24,60 73,24
-9 16,55 14,64 24,60 24,60 73,24
-12 19,97 14,64 24,60 24,60 73,24
-15 23,24 14,64 24,60 24,60 73,24
-18 26,48 14,64 24,60 24,60 73,24
-24 33,28 14,64 24,60 24,60 73,24
-30 39,46 14,64 24,60 24,60 73,24
-36 45,72 14,64 24,60 24,60 73,24
-    """,
-            "2024-02-01": """
-6 13,03 17,04 27,00 27,00 75,64
-9 16,55 17,04 27,00 27,00 75,64
-12 19,97 17,04 27,00 27,00 75,64
-15 23,24 17,04 27,00 27,00 75,64
-18 26,48 17,04 27,00 27,00 75,64
-24 33,28 17,04 27,00 27,00 75,64
-30 39,46 17,04 27,00 27,00 75,64
-36 45,72 17,04 27,00 27,00 75,64
+    Moves the consumption older than `HOT_MONTHS` months (24 by default, 0 to disable) to the compressed archive.
+
+    Those months are never fetched again, since `fetch_enedis` doesn't look further than two years back.
     """
-        },
-        "zenweekend": {
-            "2023-09-14": """
-3 9,47 25,25 17,71
-6 12,44 25,25 17,71
-9 15,63 25,25 17,71
-12 19,25 25,25 17,71
-15 22,37 25,25 17,71
-18 25,46 25,25 17,71
-24 32,32 25,25 17,71
-30 37,29 25,25 17,71
-36 43,99 25,25 17,71
-    """,
-            "2024-02-01": """
-3 9,47 27,65 20,11
-6 12,44 27,65 20,11
-9 15,63 27,65 20,11
-12 19,25 27,65 20,11
-15 22,37 27,65 20,11
-18 25,46 27,65 20,11
-24 32,32 27,65 20,11
-30 37,29 27,65 20,11
-36 43,99 27,65 20,11
-"""
-        },
-        "zenweekendhc": {
-            "2023-09-14": """
-6 13,03 26,83 18,81 18,81 18,81
-9 16,55 26,83 18,81 18,81 18,81
-12 19,97 26,83 18,81 18,81 18,81
-15 23,24 26,83 18,81 18,81 18,81
-18 26,48 26,83 18,81 18,81 18,81
-24 33,28 26,83 18,81 18,81 18,81
-30 39,46 26,83 18,81 18,81 18,81
-36 45,72 26,83 18,81 18,81 18,81
-    """,
-            "2024-02-01": """
-6 13,03 29,23 21,21 21,21 21,21
-9 16,55 29,23 21,21 21,21 21,21
-12 19,97 29,23 21,21 21,21 21,21
-15 23,24 29,23 21,21 21,21 21,21
-18 26,48 29,23 21,21 21,21 21,21
-24 33,28 29,23 21,21 21,21 21,21
-30 39,46 29,23 21,21 21,21 21,21
-36 45,72 29,23 21,21 21,21 21,21
-"""
-        },
-        "totalstdfixe": {
-            "2024-01-17": """
-3 9,51 0,1892
-6 12,50 0,1892
-12 19,08 0,1892
-15 22,14 0,1892
-18 25,17 0,1892
-24 32,05 0,1892
-30 37,71 0,1892
-36 44,62 0,1892
+    hot_months = int(config.get("HOT_MONTHS") or 24)
+    if hot_months <= 0:
+        return
+    year, month = divmod(date.today().year * 12 + date.today().month - 1 - hot_months, 12)
+    if archived := archive.compact(db, date(year, month + 1, 1)):
+        log_callback("Archived", archived, "months of consumption")
+
+
+# held while data is being fetched, so that overlapping runs (page visits, the refresh button) don't fetch the same
+# windows twice
+_fetching = asyncio.Lock()
+
+
+@profiling.profiled
+async def fetch_apis():
     """
-        },
-        "totalstdfixehc": {
-            "2024-01-17": """
-6 13,00 0,1511 0,2048
-12 19,97 0,1511 0,2048
-15 23,21 0,1511 0,2048
-18 26,41 0,1511 0,2048
-24 33,22 0,1511 0,2048
-30 39,27 0,1511 0,2048
-36 45,40 0,1511 0,2048
+    Fetches everything from the APIs, unless a fetch is already running.
     """
-        }
-    }
-
-    for plan, vals in edf_pdf_data.items():
-        plan_data = EdfPlan(plan)
-        for (dt, val), dt_end in zip(vals.items(), [(date.fromisoformat(k) - timedelta(days=1)).isoformat() for k in vals.keys()][1:] + ["9999-12-31"]):
-            val = val.strip().replace(",", "").split("\n")
-            for row in val:
-                power, sub, *kwh = row.split(" ")
-                sub = 12 * int(sub)
-                day_start = 0 if plan_data.day_kind_sql() is None else 1
-                if plan_data.is_hp_sql() is None:
-                    for day_kind, hchp in enumerate(kwh, day_start):
-                        cur.execute("INSERT OR REPLACE INTO edf_plan_slice VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                    (plan, dt, power, sub, day_kind, hchp, hchp, dt_end))
-                else:
-                    for day_kind, (hc, hp) in enumerate(itertools.batched(kwh, 2), day_start):
-                        cur.execute("INSERT OR REPLACE INTO edf_plan_slice VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                    (plan, dt, power, sub, day_kind, hp, hc, dt_end))
-
-    log_callback("committing to db")
-    db.commit()
-    log_callback("done")
+    if _fetching.locked():
+        log_callback("Fetch already running")
+        return
+    async with _fetching:
+        await _fetch_apis()
 
-async def fetch_apis():
+
+async def _fetch_apis():
+    changes = db.total_changes
+    await fetch_enedis_daily()
     await fetch_enedis()
     await fetch_tempo()
     await fetch_prices()
+    compact_consumption()
+    maintenance.after_ingest(db, db.total_changes - changes)
 
 
-async def fetch_loop():
+@profiling.profiled
+async def fetch_loop(progressive: bool = False):
+    """
+    Fetches everything. With `progressive`, only what the views need to show approximate figures is fetched (daily
+    consumption, Tempo days and prices), and the load curve is left to a `fetch_apis` run in the background.
+    """
     log_callback("fetch loop")
-    await fetch_apis()
+    if _fetching.locked():
+        log_callback("Fetch already running")
+    else:
+        async with _fetching:
+            if progressive:
+                await fetch_enedis_daily()
+                await fetch_tempo()
+                await fetch_prices()
+            else:
+                await _fetch_apis()
     add_prices_pdf()
@@ -0,0 +1,244 @@
+# coding: utf-8
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional
+
+import numpy as np
+
+import data_cache
+import db
+import history
+import pricing
+from edf_plan import EdfPlan
+
+# Tempo days in a season, running from September 1st to August 31st. Red days fall on weekdays from November to
+# March, white days on any day but Sunday.
+TEMPO_RED_DAYS = 22
+TEMPO_WHITE_DAYS = 43
+
+# complete days over which the level of the model is matched to the recent consumption
+LEVEL_DAYS = 28
+
+
+@dataclass
+class Model:
+    """
+    Seasonal model of the consumption: the energy of a slice is `level * season[day of year] * shape[weekday, slice]`.
+
+    The seasonality comes from the daily energy of each month of the year over all the stored years, so it follows
+    the weather of the past years without needing temperatures.
+    """
+    # (366,) relative daily energy for each day of the year (0-based), 1 on average
+    season: np.ndarray
+    # (7, 48) energy in Wh of each slice for each weekday (Monday being 0), for a day of average seasonality
+    shape: np.ndarray
+    # ratio of the recent consumption to what the seasonality alone predicts
+    level: float
+
+    def predict(self, days: np.ndarray) -> np.ndarray:
+        """
+        Gives the (n, 48) array of the predicted energy in Wh of each slice of the datetime64[D] `days`.
+        """
+        return self.level * self.season[day_of_year(days), None] * self.shape[weekdays(days)]
+
+
+@dataclass
+class Forecast:
+    """
+    Expected consumption and costs over a period, measured up to `measured_until` and projected for the rest. Energies
+    are in Wh, costs in 1/10000000 € (+inf where the rates are unknown).
+    """
+    name: str
+    start: date
+    end: date
+    measured_until: Optional[date]
+    energy_measured: float
+    energy_projected: float
+    cost_measured: dict[EdfPlan, float]
+    cost_projected: dict[EdfPlan, float]
+    # expected number of red and white Tempo days among the days of the period whose colour isn't known yet
+    tempo_red: float
+    tempo_white: float
+
+    def total(self, plan: EdfPlan) -> float:
+        return self.cost_measured[plan] + self.cost_projected[plan]
+
+
+def weekdays(days: np.ndarray) -> np.ndarray:
+    # 1970-01-01 was a Thursday
+    return (days.astype(np.int64) + 3) % 7
+
+
+def day_of_year(days: np.ndarray) -> np.ndarray:
+    return (days - days.astype("datetime64[Y]")).astype(np.int64)
+
+
+def fit(hist: history.History) -> Optional[Model]:
+    """
+    Fits the model to the complete days of `hist`. Returns None if there are none.
+    """
+    complete = ~np.isnan(hist.values).any(axis=1)
+    if not complete.any():
+        return None
+    days = hist.days[complete]
+    values = hist.values[complete]
+    daily = values.sum(axis=1)
+
+    # mean daily energy of each month of the year, months without data being interpolated from their neighbours
+    month = days.astype("datetime64[M]").astype(np.int64) % 12
+    counts = np.bincount(month, minlength=12)
+    known = counts > 0
+    monthly = np.bincount(month, weights=daily, minlength=12)[known] / counts[known]
+    # mid-month days of the year
+    middles = np.array([15, 45, 74, 105, 135, 166, 196, 227, 258, 288, 319, 349])
+    season = np.interp(np.arange(366), middles[known], monthly, period=365)
+    if season.mean() > 0:
+        season /= season.mean()
+    else:
+        season[:] = 1
+
+    seasonal = values / season[day_of_year(days), None]
+    weekday = weekdays(days)
+    shape = np.zeros((7, 48))
+    np.add.at(shape, weekday, seasonal)
+    per_weekday = np.bincount(weekday, minlength=7)
+    shape = np.where(per_weekday[:, None] > 0, shape / np.maximum(per_weekday, 1)[:, None], seasonal.mean(axis=0))
+
+    model = Model(season, shape, 1.0)
+    recent = slice(-LEVEL_DAYS, None)
+    predicted = model.predict(days[recent]).sum()
+    if predicted > 0:
+        model.level = float(np.clip(daily[recent].sum() / predicted, 0.5, 2))
+    return model
+
+
+def tempo_season(day: date) -> tuple[date, date]:
+    """
+    Gives the first and last days of the Tempo season `day` belongs to.
+    """
+    year = day.year if day.month >= 9 else day.year - 1
+    return date(year, 9, 1), date(year + 1, 8, 31)
+
+
+def tempo_probabilities(start: date, end: date) -> np.ndarray:
+    """
+    Gives an (n, 3) array of the probabilities of each Tempo colour (blue, white, red) for the n days between `start`
+    and `end` (inclusive).
+
+    Days whose colour is stored are certain. For the others, the red and white days left in their season are spread
+    over the remaining days that can have them.
+    """
+    days = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D") + 1)
+    probabilities = np.zeros((len(days), 3))
+    for season_start, season_end in sorted({tempo_season(start), tempo_season(end)}):
+        season_days = np.arange(np.datetime64(season_start, "D"), np.datetime64(season_end, "D") + 1)
+        rows = np.array(db.cur.execute(
+            "SELECT year, month, day, tempo FROM tempo WHERE (year, month, day) BETWEEN (?, ?, ?) AND (?, ?, ?)",
+            (season_start.year, season_start.month, season_start.day, season_end.year, season_end.month,
+             season_end.day)).fetchall(), dtype=np.int64).reshape(-1, 4)
+        colors = np.zeros(len(season_days), dtype=np.int64)
+        colors[(history.ymd_to_days(rows[:, 0], rows[:, 1], rows[:, 2]) - season_days[0]).astype(np.int64)] = rows[:, 3]
+        unknown = colors == 0
+        weekday = weekdays(season_days)
+        month = season_days.astype("datetime64[M]").astype(np.int64) % 12 + 1
+        can_red = unknown & (weekday < 5) & ((month >= 11) | (month <= 3))
+        can_white = unknown & (weekday < 6)
+
+        red = np.zeros(len(season_days))
+        red_left = max(0, TEMPO_RED_DAYS - np.count_nonzero(colors == 3))
+        if can_red.any():
+            red[can_red] = min(1.0, red_left / np.count_nonzero(can_red))
+        white = np.zeros(len(season_days))
+        white_left = max(0, TEMPO_WHITE_DAYS - np.count_nonzero(colors == 2))
+        room = np.where(can_white, 1 - red, 0)
+        if room.sum() > 0:
+            white = np.minimum(room, white_left * room / room.sum())
+        season_probabilities = np.stack([1 - red - white, white, red], axis=1)
+        season_probabilities[~unknown] = np.eye(3)[np.maximum(colors[~unknown], 1) - 1]
+
+        lo = max(0, int((season_days[0] - days[0]).astype(np.int64)))
+        hi = min(len(days), int((season_days[-1] - days[0]).astype(np.int64)) + 1)
+        offset = int((days[0] - season_days[0]).astype(np.int64))
+        probabilities[lo:hi] = season_probabilities[lo + offset:hi + offset]
+    return probabilities
+
+
+def forecast(model: Model, name: str, start: date, end: date, plans: list[EdfPlan] = EdfPlan) -> Forecast:
+    """
+    Forecasts the period from `start` to `end` (inclusive): the stored consumption is priced as is, and the missing
+    slices and days are filled with the predictions of `model`.
+
+    Plans whose day kinds depend on Tempo colours that aren't known yet are priced with the expected cost over the
+    colours the day can take.
+    """
+    period = history.load_history(start, end)
+    measured = ~np.isnan(period.values)
+    filled = period.with_values(np.where(measured, period.values, model.predict(period.days)))
+    known_days = period.days[measured.any(axis=1)]
+
+    before = start - timedelta(days=1)
+    probabilities = tempo_probabilities(before, end)
+    colors = period.tempo
+    unknown = colors == 0
+
+    cost_measured = {}
+    cost_projected = {}
+    for plan in plans:
+        offsets = plan.tempo_offsets()
+        if offsets is None or not unknown.any():
+            costs = pricing.slice_costs(plan, filled)
+        else:
+            # probabilities of the colour each slice's day kind depends on
+            relevant = probabilities[np.arange(len(period))[:, None] + offsets]
+            costs = 0
+            for color in (1, 2, 3):
+                probability = relevant[..., color - 1]
+                color_costs = pricing.slice_costs(plan, filled.with_tempo(np.where(unknown, color, colors)))
+                # colours that can't happen don't count, even where their rates are unknown
+                costs = costs + np.where(probability > 0, probability * color_costs, 0)
+        cost_measured[plan] = pricing.total_cost(np.where(measured, costs, 0))
+        cost_projected[plan] = pricing.total_cost(np.where(measured, 0, costs))
+
+    remaining = probabilities[1:][unknown[1:]]
+    return Forecast(
+        name=name,
+        start=start,
+        end=end,
+        measured_until=known_days[-1].astype(date) if len(known_days) else None,
+        energy_measured=float(np.nansum(period.values)),
+        energy_projected=float(filled.values[~measured].sum()),
+        cost_measured=cost_measured,
+        cost_projected=cost_projected,
+        tempo_red=float(remaining[:, 2].sum()),
+        tempo_white=float(remaining[:, 1].sum()),
+    )
+
+
+def periods(today: date) -> list[tuple[str, date, date]]:
+    """
+    Gives the periods that are forecast: the current month, year and Tempo season.
+    """
+    next_month = date(today.year + today.month // 12, today.month % 12 + 1, 1)
+    return [
+        ("Mois en cours", today.replace(day=1), next_month - timedelta(days=1)),
+        ("Année en cours", date(today.year, 1, 1), date(today.year, 12, 31)),
+        ("Saison Tempo en cours", *tempo_season(today)),
+    ]
+
+
+def get(today: Optional[date] = None) -> list[Forecast]:
+    """
+    Gives the forecasts of the periods containing `today` (the current day by default), empty if there is no complete
+    day of consumption to fit the model to yet.
+
+    The model is fitted once per data version, and the forecasts computed once per data version and day.
+    """
+    today = today or date.today()
+
+    def compute():
+        model = data_cache.cached("forecast_model", lambda: fit(data_cache.cached("history", history.load_history)))
+        if model is None:
+            return []
+        return [forecast(model, name, start, end) for name, start, end in periods(today)]
+
+    return data_cache.cached(("forecast", today), compute)
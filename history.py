@@ -0,0 +1,96 @@
+# coding: utf-8
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional
+
+import numpy as np
+
+import archive
+import db
+
+
+@dataclass
+class History:
+    """
+    The consumption history laid out as one row of 48 slices per day, for vectorized processing.
+
+    - days: datetime64[D] array of n consecutive days
+    - values: (n, 48) float array of consumption in Wh, NaN where no reading was stored
+    - tempo: (n + 1,) int array of Tempo colours, the first entry being the day before `days[0]` (0 when unknown)
+    """
+    days: np.ndarray
+    values: np.ndarray
+    tempo: np.ndarray
+
+    def __len__(self):
+        return len(self.days)
+
+    def with_values(self, values: np.ndarray) -> "History":
+        return History(self.days, values, self.tempo)
+
+    def with_tempo(self, tempo: np.ndarray) -> "History":
+        return History(self.days, self.values, tempo)
+
+    def extend(self, newer: "History") -> "History":
+        """
+        Gives the history with the days of `newer` replacing or following those of `self`. `newer` must start at most
+        one day after the end of `self`.
+        """
+        if not len(self):
+            return newer
+        keep = int((newer.days[0] - self.days[0]).astype(np.int64)) if len(newer) else len(self)
+        return History(np.concatenate([self.days[:keep], newer.days]),
+                       np.concatenate([self.values[:keep], newer.values]),
+                       np.concatenate([self.tempo[:keep], newer.tempo]))
+
+
+def ymd_to_days(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """
+    Converts year/month/day integer arrays to a datetime64[D] array.
+    """
+    months = np.datetime64("1970-01", "M") + ((year - 1970) * 12 + month - 1).astype("timedelta64[M]")
+    return months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+
+
+def load_history(start: Optional[date] = None, end: Optional[date] = None) -> History:
+    """
+    Loads the consumption between `start` and `end` (inclusive, defaulting to the stored range) from both storage
+    tiers.
+
+    Values are halved with an integer division, like `query_plan_stats` does, so that costs computed from the history
+    match the ones computed in SQL.
+    """
+    if start is None or end is None:
+        stored = archive.stored_days(db.cur)
+        if stored is None:
+            return History(np.array([], dtype="datetime64[D]"), np.empty((0, 48)), np.zeros(1, dtype=np.int8))
+        start = start or stored[0]
+        end = end or stored[1]
+
+    days = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D") + 1)
+    values = np.full((len(days), 48), np.nan)
+    flat = values.reshape(-1)
+    for year, month, data in db.cur.execute(
+            "SELECT year, month, data FROM consumption_archive WHERE (year, month) BETWEEN (?, ?) AND (?, ?)",
+            (start.year, start.month, end.year, end.month)).fetchall():
+        month_values = archive.unpack(data)
+        offset = int((np.datetime64(date(year, month, 1)) - days[0]).astype(np.int64)) * 48
+        lo, hi = max(offset, 0), min(offset + len(month_values), len(flat))
+        packed = month_values[lo - offset:hi - offset]
+        flat[lo:hi] = np.where(packed == archive.MISSING, np.nan, packed // 2)
+
+    rows = np.array(db.cur.execute(
+        "SELECT year, month, day, slice, value FROM consumption "
+        "WHERE (year, month, day) BETWEEN (?, ?, ?) AND (?, ?, ?)",
+        (start.year, start.month, start.day, end.year, end.month, end.day)).fetchall(), dtype=np.int64).reshape(-1, 5)
+    day_idx = (ymd_to_days(rows[:, 0], rows[:, 1], rows[:, 2]) - days[0]).astype(np.int64)
+    values[day_idx, rows[:, 3]] = rows[:, 4] // 2
+
+    before = start - timedelta(days=1)
+    tempo = np.zeros(len(days) + 1, dtype=np.int8)
+    rows = np.array(db.cur.execute(
+        "SELECT year, month, day, tempo FROM tempo WHERE (year, month, day) BETWEEN (?, ?, ?) AND (?, ?, ?)",
+        (before.year, before.month, before.day, end.year, end.month, end.day)).fetchall(), dtype=np.int64).reshape(-1, 4)
+    tempo[(ymd_to_days(rows[:, 0], rows[:, 1], rows[:, 2]) - days[0]).astype(np.int64) + 1] = rows[:, 3]
+
+    return History(days, values, tempo)
@@ -0,0 +1,83 @@
+# coding: utf-8
+from dataclasses import dataclass
+
+import numpy as np
+
+import pricing
+from edf_plan import EdfPlan
+from history import History
+
+
+@dataclass
+class FlexibleLoad:
+    """
+    A load whose daily energy can be moved anywhere inside a time window (EV charging, water heater, ...).
+
+    The window starts at slice `start` and ends before slice `end` (0-47); when `end <= start`, it goes past midnight
+    and ends the next day. The load is assumed to currently run at full power from the start of its window.
+    """
+    name: str
+    energy: float  # Wh per day
+    max_power: float  # W
+    start: int
+    end: int
+
+    def window(self) -> np.ndarray:
+        """
+        Gives the offsets of the window's slices from the start of the day it belongs to.
+        """
+        return self.start + np.arange((self.end - self.start - 1) % 48 + 1)
+
+    def usual_profile(self) -> np.ndarray:
+        """
+        Gives the energy used in each slice of the window when the load runs as soon as the window opens.
+        """
+        per_slice = self.max_power / 2
+        return np.clip(self.energy - per_slice * np.arange(len(self.window())), 0, per_slice)
+
+
+def shift_load(values: np.ndarray, prices: np.ndarray, load: FlexibleLoad) -> np.ndarray:
+    """
+    Moves `load` to the cheapest slices of its window, each day, and gives the resulting (n, 48) consumption.
+
+    Only the energy actually found in the usual slices is moved, and it is only moved to slices that have readings.
+    Slices are filled at full power in increasing order of price, the earliest slice winning ties.
+    """
+    n = len(values)
+    flat_values = values.reshape(-1).copy()
+    flat_prices = prices.reshape(-1)
+    idx = (np.arange(n) * 48)[:, None] + load.window()
+    valid = idx < n * 48
+    idx = np.where(valid, idx, 0)
+
+    window_values = np.where(valid, flat_values[idx], np.nan)
+    available = ~np.isnan(window_values)
+    removed = np.minimum(load.usual_profile(), np.where(available, window_values, 0))
+    moved = removed.sum(axis=1, keepdims=True)
+
+    order = np.argsort(np.where(available, flat_prices[idx], np.inf), axis=1, kind="stable")
+    capacity = np.where(np.take_along_axis(available, order, axis=1), load.max_power / 2, 0)
+    filled = np.clip(moved - (np.cumsum(capacity, axis=1) - capacity), 0, capacity)
+    added = np.empty_like(filled)
+    np.put_along_axis(added, order, filled, axis=1)
+
+    flat_values[idx[valid]] += (added - removed)[valid]
+    return flat_values.reshape(values.shape)
+
+
+def simulate(history: History, loads: list[FlexibleLoad], plans: list[EdfPlan] = EdfPlan, price_mode="real") \
+        -> dict[EdfPlan, tuple[float, float]]:
+    """
+    Moves `loads` to the cheapest slices for each of `plans` and re-costs the history.
+
+    Gives, for each plan, the total cost in 1/10000000 € of the history as it happened and after moving the loads.
+    """
+    res = {}
+    for plan in plans:
+        prices = pricing.slice_prices(plan, history, price_mode)
+        values = history.values
+        for load in loads:
+            values = shift_load(values, prices[0], load)
+        res[plan] = (pricing.total_cost(pricing.slice_costs(plan, history, prices=prices)),
+                     pricing.total_cost(pricing.slice_costs(plan, history.with_values(values), prices=prices)))
+    return res
@@ -0,0 +1,220 @@
+# coding: utf-8
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from datetime import date, timedelta
+from pathlib import Path
+
+import standin
+from report import fresh_processes
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--meters", type=int, default=1, help="number of meters backfilled")
+    parser.add_argument("--workers", type=int, default=None, help="number of meters backfilled at once")
+    parser.add_argument("--days", type=int, default=90, help="days of history of each meter")
+    parser.add_argument("--standin", help="URL of a running stand-in server (one is started here by default, with "
+                                          "the options below)")
+    parser.add_argument("--root", type=Path, help="directory where the meters are created (kept afterwards; a "
+                                                  "temporary one by default)")
+    parser.add_argument("--output", "-o", type=Path, help="JSON file to write the results to")
+    standin.add_behavior_arguments(parser)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Gives the `q` (0 to 1) percentile of `values` by the nearest-rank method.
+    """
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(q * len(values) + 0.5) - 1))]
+
+
+def latency_summary(values: list[float]) -> dict:
+    return {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99), "max": max(values, default=math.nan)}
+
+
+def _backfill_meter(directory: str) -> dict:
+    """
+    Runs in a fresh worker process, for the same reasons as `report._report_meter`. Backfills a new meter and gives
+    the timings of its requests.
+    """
+    os.chdir(directory)
+    # (endpoint, seconds, rows, ok), in order
+    requests = []
+
+    def timed(endpoint_of, f, count):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                res = await f(*args, **kwargs)
+            except Exception:
+                requests.append((endpoint_of(args), time.perf_counter() - start, 0, False))
+                raise
+            requests.append((endpoint_of(args), time.perf_counter() - start, count(res), True))
+            return res
+
+        return wrapper
+
+    from apis import datagouvfr, myelectricaldata, tempo
+    myelectricaldata.fetch_api = timed(lambda args: args[0], myelectricaldata.fetch_api,
+                                       lambda res: len(res.get("meter_reading", {}).get("interval_reading", [])))
+    tempo.get_days = timed(lambda args: "joursTempo", tempo.get_days, len)
+    datagouvfr.get_resource_content = timed(lambda args: "tariffs", datagouvfr.get_resource_content,
+                                            lambda res: res.count("\n") - 1)
+
+    # importing main.py to parse the arguments already loaded the settings of the former directory
+    import config
+    config.load()
+    import maintenance
+    import migrations
+    maintenance.log_callback = migrations.log_callback = lambda *args: None
+
+    start = time.perf_counter()
+    import archive
+    import db
+
+    async def backfill():
+        await db.load_meter_info()
+        import fetch_edf
+        fetch_edf.log_callback = lambda *args: None
+        await fetch_edf.fetch_loop()
+
+    result = {"meter": Path(directory).name}
+    try:
+        asyncio.run(backfill())
+    except Exception as e:
+        # aiohttp's exceptions can't be sent back to the parent process
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed"] = time.perf_counter() - start
+    result["requests"] = requests
+    stored = archive.stored_days(db.cur)
+    result["curve_days"] = 0 if stored is None else (stored[1] - stored[0]).days + 1
+    return result
+
+
+def start_standin(args: argparse.Namespace) -> str:
+    """
+    Serves a stand-in in a background thread of this process and gives its URL.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    from aiohttp import web
+    runner = web.AppRunner(standin.StandIn.from_args(args).app())
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def create_meters(root: Path, count: int, days: int, base_url: str) -> list[str]:
+    """
+    Creates the directories of `count` new meters whose history starts `days` days ago, fetching from the stand-in.
+    Meters left in `root` by a previous run start over from an empty database.
+    """
+    start = date.today() - timedelta(days=days)
+    settings = {"OVERRIDE_START_DATE": start.isoformat(), "HOT_MONTHS": "0",
+                **standin.roots(base_url)}
+    directories = []
+    for i in range(count):
+        directory = root / f"meter{i:04d}"
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in ("app.db", "app.db-wal", "app.db-shm"):
+            (directory / name).unlink(missing_ok=True)
+        with open(directory / ".env", "w", encoding="utf-8") as f:
+            # one token per meter, as rate limits apply per token
+            for key, value in {"METER_ID": f"{i:014d}", "MED_TOKEN": f"loadtest{i}", **settings}.items():
+                f.write(f'{key}="{value}"\n')
+        directories.append(str(directory))
+    return directories
+
+
+def run(args: argparse.Namespace):
+    base_url = args.standin.rstrip("/") if args.standin else start_standin(args)
+    root = args.root or Path(tempfile.mkdtemp(prefix="elecanalysis-loadtest-"))
+    directories = create_meters(root, args.meters, args.days, base_url)
+    print(f"Backfilling {args.meters} meters of {args.days} days from {base_url}")
+
+    start = time.perf_counter()
+    results = []
+    failures = {}
+    calls = {Path(directory).name: (directory,) for directory in directories}
+    for name, future in fresh_processes(_backfill_meter, calls, args.workers):
+        try:
+            result = future.result()
+        except Exception as e:
+            failures[name] = repr(e)
+            print(name, e, file=sys.stderr)
+            continue
+        results.append(result)
+        if "error" in result:
+            failures[result["meter"]] = result["error"]
+            print(result["meter"], result["error"], file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    by_endpoint = defaultdict(list)
+    errors = defaultdict(int)
+    rows = 0
+    for result in results:
+        for endpoint, seconds, count, ok in result["requests"]:
+            if ok:
+                by_endpoint[endpoint].append(seconds)
+                rows += count
+            else:
+                errors[endpoint] += 1
+    windows = len(by_endpoint.get("consumption_load_curve", []))
+    summary = {
+        "meters": args.meters,
+        "failed": failures,
+        "days": args.days,
+        "elapsed": elapsed,
+        "windows": windows,
+        "windows_per_second": windows / elapsed,
+        "rows": rows,
+        "rows_per_second": rows / elapsed,
+        # meters whose load curve doesn't reach yesterday, the backfill having stopped at an error (`fetch_enedis`
+        # doesn't look further than two years back)
+        "incomplete": sorted(r["meter"] for r in results
+                             if "error" not in r and r["curve_days"] < min(args.days, 2 * 365 - 1)),
+        "meter_seconds": latency_summary([r["elapsed"] for r in results]),
+        "request_seconds": {endpoint: latency_summary(by_endpoint[endpoint])
+                            for endpoint in sorted(by_endpoint.keys() | errors.keys())},
+        "request_errors": dict(errors),
+    }
+    try:
+        with urllib.request.urlopen(base_url + "/stats") as res:
+            summary["served"] = json.load(res)
+    except OSError:
+        pass
+
+    print(f"{args.meters - len(failures)} meters backfilled ({len(summary['incomplete'])} incomplete), "
+          f"{len(failures)} failed, in {elapsed:.1f} s")
+    print(f"{windows} load curve windows ({summary['windows_per_second']:.1f}/s), "
+          f"{rows} rows ({summary['rows_per_second']:.0f}/s)")
+    print(f"{'':<30}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for endpoint, s in summary["request_seconds"].items():
+        print(f"{endpoint:<30}{s['count']:>8}{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}"
+              f"{s['p99'] * 1000:>10.1f}{s['max'] * 1000:>10.1f}{errors.get(endpoint, 0):>8}")
+    s = summary["meter_seconds"]
+    print(f"{'whole backfill of a meter':<30}{s['count']:>8}{s['p50'] * 1000:>10.0f}{s['p95'] * 1000:>10.0f}"
+          f"{s['p99'] * 1000:>10.0f}{s['max'] * 1000:>10.0f}{len(failures):>8}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    if args.root is None:
+        shutil.rmtree(root, ignore_errors=True)
@@ -1,18 +1,45 @@
 import argparse
+import multiprocessing
 import sys
 
 import hacks
 
+if __name__ == "__main__":
+    # must run before parsing the arguments, which are not ours in frozen worker processes
+    multiprocessing.freeze_support()
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--app", action="store_true", help="Run as desktop app", default=hacks.in_bundle)
+subparsers = parser.add_subparsers(dest="command")
+import cohort
+import report
+report.add_arguments(subparsers.add_parser("report", help="Price many meters without the UI"))
+cohort.add_arguments(subparsers.add_parser("cohort", help="Index the features of many meters to rank them"))
+# these import the API clients, which load the settings of the current directory: they are only imported to run them,
+# so that spawned workers, which import this file before moving to their meter's directory, don't load the wrong ones
+subparsers.add_parser("standin", help="Serve local stand-ins for the data APIs", add_help=False)
+subparsers.add_parser("loadtest", help="Measure the backfill of many meters against stand-ins", add_help=False)
 args, unknown = parser.parse_known_args()
 
-hacks.init()
+# Spawned processes import this file as __mp_main__ with the same arguments. The web UI is served from such a process
+# (NiceGUI's reload worker), which must register the pages again, but the report workers must not run anything.
+if __name__ == "__main__" or __name__ == "__mp_main__" and args.command is None and not args.app:
+    hacks.init()
 
-if args.app:
-    import desktop
-    desktop.run()
-else:
-    import asyncio
-    import web_ui
-    asyncio.run(web_ui.run_ui())
+    if args.command == "report":
+        report.run(args)
+    elif args.command == "cohort":
+        cohort.run(args)
+    elif args.command in ("standin", "loadtest"):
+        import importlib
+        module = importlib.import_module(args.command)
+        command_parser = argparse.ArgumentParser(prog=f"{parser.prog} {args.command}")
+        module.add_arguments(command_parser)
+        module.run(command_parser.parse_args(unknown))
+    elif args.app:
+        import desktop
+        desktop.run()
+    else:
+        import asyncio
+        import web_ui
+        asyncio.run(web_ui.run_ui())
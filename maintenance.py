@@ -0,0 +1,99 @@
+# coding: utf-8
+import sqlite3
+
+from config import config
+from edf_plan import EdfPlan, query_plan_prices_period, query_params
+
+log_callback = print
+
+# rows changed by an ingest past which the statistics are rebuilt from scratch rather than refreshed
+LARGE_INGEST = 10000
+
+# free pages kept before the file is shrunk
+VACUUM_THRESHOLD = 256
+
+
+def role_pragmas(role: str) -> dict[str, object]:
+    """
+    Gives the pragmas to apply to a connection of the given role, `writer` (the app) or `reader` (report workers).
+
+    The page cache and memory-mapped sizes can be set in MiB with `SQLITE_CACHE_MB` and `SQLITE_MMAP_MB`.
+    """
+    pragmas = {
+        # negative means KiB rather than pages
+        "cache_size": -1024 * int(config.get("SQLITE_CACHE_MB") or 64),
+        "mmap_size": 1024 * 1024 * int(config.get("SQLITE_MMAP_MB") or 256),
+        "temp_store": "MEMORY",
+    }
+    match role:
+        case "writer":
+            # readers don't block ingestion, and commits only sync at checkpoints
+            pragmas["journal_mode"] = "WAL"
+            pragmas["synchronous"] = "NORMAL"
+            pragmas["journal_size_limit"] = 64 * 1024 * 1024
+        case "reader":
+            pragmas["query_only"] = 1
+        case _:
+            raise ValueError(role)
+    return pragmas
+
+
+def configure(conn: sqlite3.Connection, role: str):
+    for name, value in role_pragmas(role).items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection):
+    """
+    Switches the database to incremental auto-vacuum, which needs a full VACUUM the first time.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        log_callback("Enabling incremental vacuum")
+        conn.commit()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def cost_query_plans(conn: sqlite3.Connection) -> dict[str, list[str]]:
+    """
+    Gives the query plans SQLite picks for the cost queries, by name.
+    """
+    params = query_params(power=0)
+    queries = {
+        "monthly": query_plan_prices_period(list(EdfPlan), "real", "strftime('%Y-%m', c.date)", with_total=True),
+        "daily": query_plan_prices_period(list(EdfPlan), "current"),
+    }
+    return {name: [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+            for name, query in queries.items()}
+
+
+def after_ingest(conn: sqlite3.Connection, changes: int):
+    """
+    Keeps the planner statistics and the file size in check after `changes` rows were written.
+
+    Large ingests (such as the first backfill or an archival) get a full ANALYZE, smaller ones the cheaper
+    `PRAGMA optimize`, which only analyzes tables whose statistics are stale. Plan changes of the cost queries are
+    logged. Pages freed by replaces and archival are then returned to the file system.
+    """
+    if changes:
+        before = cost_query_plans(conn)
+        if changes >= LARGE_INGEST or conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+            log_callback("Analyzing database")
+            conn.execute("ANALYZE")
+        else:
+            conn.execute("PRAGMA optimize")
+        conn.commit()
+        after = cost_query_plans(conn)
+        for name in before:
+            if before[name] != after[name]:
+                log_callback(f"Query plan of the {name} cost query changed")
+                log_callback("  before:\n    " + "\n    ".join(before[name]))
+                log_callback("  after:\n    " + "\n    ".join(after[name]))
+
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free > VACUUM_THRESHOLD:
+        conn.execute(f"PRAGMA incremental_vacuum({free})").fetchall()
+        conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
@@ -0,0 +1,250 @@
+# coding: utf-8
+import sqlite3
+from dataclasses import dataclass
+from typing import Callable
+
+log_callback = print
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Connection], object]
+    # `apply` is a generator that yields its progress (0 to 1) between batches, each batch being committed on its own
+    # so that an interrupted migration picks up where it stopped; what runs after the last yield is committed along
+    # with the new schema version
+    online: bool = False
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(description, online=False):
+    def decorator(f):
+        MIGRATIONS.append(Migration(len(MIGRATIONS) + 1, description, f, online))
+        return f
+
+    return decorator
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """
+    Gives the version of the schema of `conn`, 0 for an empty database.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'config'").fetchone() is None:
+        return 0
+    res = conn.execute("SELECT value FROM config WHERE key = 'schema_version'").fetchone()
+    return 0 if res is None else int(res[0])
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Brings the schema of `conn` up to date, running each pending migration in its own transaction.
+    """
+    current = schema_version(conn)
+    if current > len(MIGRATIONS):
+        raise RuntimeError(f"app.db has schema version {current}, this version of elecanalysis only knows up to "
+                           f"{len(MIGRATIONS)}")
+    conn.commit()
+    for m in MIGRATIONS[current:]:
+        log_callback(f"Migrating database to version {m.version}: {m.description}")
+        conn.execute("BEGIN")
+        try:
+            res = m.apply(conn)
+            if m.online:
+                for progress in res:
+                    conn.commit()
+                    log_callback(f"{m.description}: {progress:.0%}")
+                    conn.execute("BEGIN")
+            conn.execute("INSERT OR REPLACE INTO config VALUES ('schema_version', ?)", (str(m.version),))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+CONSUMPTION_COLUMNS = """
+    year INTEGER,
+    month INTEGER,
+    day INTEGER,
+    slice INTEGER CHECK (slice BETWEEN 0 AND 47),
+    value INTEGER,
+    date TEXT GENERATED ALWAYS AS (PRINTF('%04d-%02d-%02d', year, month, day)) VIRTUAL,
+    hour integer GENERATED ALWAYS AS (slice / 2) VIRTUAL,
+    PRIMARY KEY (year, month, day, slice)
+"""
+
+# both tiers, with the same columns as `consumption`
+CONSUMPTION_ALL_VIEW = """CREATE VIEW IF NOT EXISTS consumption_all AS
+    SELECT year, month, day, slice, value, date, hour FROM consumption
+    UNION ALL
+    SELECT a.year, a.month, j.key / 48 + 1, j.key % 48, j.value,
+        PRINTF('%04d-%02d-%02d', a.year, a.month, j.key / 48 + 1), j.key % 48 / 2
+    FROM consumption_archive a, json_each(archive_json(a.data)) j
+    WHERE j.value <> -1;"""
+
+
+# the load curve, with the days that only have a daily total spread over the profile of their weekday
+CONSUMPTION_APPROX_VIEW = """CREATE VIEW IF NOT EXISTS consumption_approx AS
+    SELECT year, month, day, slice, value, date, hour FROM consumption_all
+    UNION ALL
+    SELECT d.year, d.month, d.day, p.slice, CAST(ROUND(2 * d.energy * p.weight) AS INTEGER),
+        PRINTF('%04d-%02d-%02d', d.year, d.month, d.day), p.slice / 2
+    FROM consumption_daily d JOIN consumption_profile p
+        ON p.weekday = (CAST(strftime('%w', PRINTF('%04d-%02d-%02d', d.year, d.month, d.day)) AS INTEGER) + 6) % 7
+    WHERE NOT EXISTS (SELECT 1 FROM consumption_day c
+                      WHERE c.year = d.year AND c.month = d.month AND c.day = d.day);"""
+
+
+@migration("initial schema")
+def initial_schema(conn: sqlite3.Connection):
+    # databases created before migrations existed already have these
+    conn.execute(f"CREATE TABLE IF NOT EXISTS consumption ({CONSUMPTION_COLUMNS});")
+    conn.execute("""CREATE TABLE IF NOT EXISTS tempo (
+        year INTEGER,
+        month INTEGER,
+        day INTEGER,
+        tempo INTEGER CHECK (tempo BETWEEN 0 AND 3),
+        date TEXT GENERATED ALWAYS AS (PRINTF('%04d-%02d-%02d', year, month, day)) VIRTUAL,
+        PRIMARY KEY (year, month, day)
+    );""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tempo_date ON tempo (date);")
+    conn.execute("""CREATE TABLE IF NOT EXISTS config (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS edf_plan_slice (
+        plan_id TEXT,
+        start TEXT,
+        power INTEGER,
+        subscription INTEGER,
+        day_kind INTEGER,
+        kwh_hp INTEGER,
+        kwh_hc INTEGER,
+        end TEXT,
+        PRIMARY KEY (plan_id, power, day_kind, start)
+    );""")
+
+
+@migration("consumption archive")
+def consumption_archive(conn: sqlite3.Connection):
+    conn.execute("""CREATE TABLE IF NOT EXISTS consumption_archive (
+        year INTEGER,
+        month INTEGER,
+        data BLOB,
+        slices INTEGER,
+        total INTEGER,
+        peak INTEGER,
+        PRIMARY KEY (year, month)
+    );""")
+    conn.execute(CONSUMPTION_ALL_VIEW)
+
+
+@migration("consumption clustered by date", online=True)
+def consumption_without_rowid(conn: sqlite3.Connection):
+    # stores the readings in the primary key b-tree itself, which halves the size of the table and its index and lets
+    # date range scans read contiguous pages
+    conn.execute(f"CREATE TABLE IF NOT EXISTS consumption_new ({CONSUMPTION_COLUMNS}) WITHOUT ROWID;")
+    # months already copied by an interrupted run are skipped
+    months = conn.execute("SELECT DISTINCT year, month FROM consumption "
+                          "EXCEPT SELECT DISTINCT year, month FROM consumption_new ORDER BY year, month").fetchall()
+    for i, (year, month) in enumerate(months):
+        conn.execute("INSERT INTO consumption_new (year, month, day, slice, value) "
+                     "SELECT year, month, day, slice, value FROM consumption WHERE year = ? AND month = ?",
+                     (year, month))
+        yield (i + 1) / len(months)
+    conn.execute("DROP VIEW IF EXISTS consumption_all;")
+    conn.execute("DROP TABLE consumption;")
+    conn.execute("ALTER TABLE consumption_new RENAME TO consumption;")
+    conn.execute(CONSUMPTION_ALL_VIEW)
+
+
+@migration("consumption aggregates", online=True)
+def consumption_aggregates(conn: sqlite3.Connection):
+    # kept up to date by `aggregates.Aggregator` during ingestion
+    conn.execute("""CREATE TABLE IF NOT EXISTS consumption_day (
+        year INTEGER,
+        month INTEGER,
+        day INTEGER,
+        total INTEGER,
+        slices INTEGER,
+        min INTEGER,
+        max INTEGER,
+        PRIMARY KEY (year, month, day)
+    ) WITHOUT ROWID;""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS consumption_month (
+        year INTEGER,
+        month INTEGER,
+        total INTEGER,
+        slices INTEGER,
+        PRIMARY KEY (year, month)
+    ) WITHOUT ROWID;""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS consumption_weekly (
+        weekday INTEGER CHECK (weekday BETWEEN 0 AND 6),
+        slice INTEGER CHECK (slice BETWEEN 0 AND 47),
+        total INTEGER,
+        count INTEGER,
+        PRIMARY KEY (weekday, slice)
+    ) WITHOUT ROWID;""")
+    # months already aggregated by an interrupted run are skipped
+    months = conn.execute("SELECT year, month FROM consumption GROUP BY year, month "
+                          "UNION SELECT year, month FROM consumption_archive "
+                          "EXCEPT SELECT year, month FROM consumption_month ORDER BY year, month").fetchall()
+    for i, (year, month) in enumerate(months):
+        conn.execute("INSERT INTO consumption_day SELECT year, month, day, SUM(value), COUNT(*), MIN(value), "
+                     "MAX(value) FROM consumption_all WHERE year = ? AND month = ? GROUP BY day", (year, month))
+        conn.execute("INSERT INTO consumption_month SELECT year, month, SUM(total), SUM(slices) FROM consumption_day "
+                     "WHERE year = ? AND month = ? GROUP BY year, month", (year, month))
+        conn.execute("""INSERT INTO consumption_weekly
+            SELECT (CAST(strftime('%w', date) AS INTEGER) + 6) % 7 AS weekday, slice, SUM(value), COUNT(*)
+            FROM consumption_all WHERE year = ? AND month = ? GROUP BY weekday, slice
+            ON CONFLICT (weekday, slice) DO UPDATE SET total = total + excluded.total, count = count + excluded.count""",
+                     (year, month))
+        yield (i + 1) / len(months)
+
+
+@migration("daily consumption")
+def daily_consumption(conn: sqlite3.Connection):
+    # daily energy in Wh and peak power in VA, fetched before the load curve to show approximate figures right away
+    conn.execute("""CREATE TABLE IF NOT EXISTS consumption_daily (
+        year INTEGER,
+        month INTEGER,
+        day INTEGER,
+        energy INTEGER,
+        peak INTEGER,
+        peak_time TEXT,
+        PRIMARY KEY (year, month, day)
+    ) WITHOUT ROWID;""")
+    # share of the daily energy that goes to each slice, by weekday (Monday being 0), from the mean load curve; flat
+    # for weekdays without any
+    conn.execute("""CREATE VIEW IF NOT EXISTS consumption_profile AS
+        WITH RECURSIVE slots(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM slots WHERE n < 7 * 48 - 1),
+        means AS (
+            SELECT n / 48 AS weekday, n % 48 AS slice, COALESCE(w.total * 1.0 / w.count, 0) AS mean
+            FROM slots LEFT JOIN consumption_weekly w ON w.weekday = n / 48 AND w.slice = n % 48
+        )
+        SELECT weekday, slice,
+            COALESCE(mean / NULLIF(SUM(mean) OVER (PARTITION BY weekday), 0), 1.0 / 48) AS weight
+        FROM means;""")
+    conn.execute(CONSUMPTION_APPROX_VIEW)
+
+
+@migration("archive without summaries")
+def archive_without_summaries(conn: sqlite3.Connection):
+    # month totals come from `consumption_month`, the archive only holds the readings; the table is rebuilt rather
+    # than altered, as DROP COLUMN needs SQLite 3.35
+    conn.execute("""CREATE TABLE IF NOT EXISTS consumption_archive_new (
+        year INTEGER,
+        month INTEGER,
+        data BLOB,
+        PRIMARY KEY (year, month)
+    );""")
+    conn.execute("INSERT INTO consumption_archive_new SELECT year, month, data FROM consumption_archive;")
+    # renaming checks the views, which must not refer to the table being replaced
+    conn.execute("DROP VIEW IF EXISTS consumption_approx;")
+    conn.execute("DROP VIEW IF EXISTS consumption_all;")
+    conn.execute("DROP TABLE consumption_archive;")
+    conn.execute("ALTER TABLE consumption_archive_new RENAME TO consumption_archive;")
+    conn.execute(CONSUMPTION_ALL_VIEW)
+    conn.execute(CONSUMPTION_APPROX_VIEW)
@@ -0,0 +1,95 @@
+# coding: utf-8
+import json
+import os
+import sqlite3
+from calendar import monthrange
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Callable, Optional
+
+import archive
+import maintenance
+from apis import myelectricaldata
+from edf_plan import EdfPlan, query_plan_prices_period, query_params
+
+# maps a YYYY-MM-DD date to the label of the period it belongs to, as in the cost table
+PERIOD_KEYS: dict[str, Callable[[str], str]] = {
+    "quotidien": lambda d: f"{d[8:10]}/{d[5:7]}",
+    "mensuel": lambda d: d[:7],
+    "annuel": lambda d: d[:4],
+}
+
+# worker-local read-only connections, with the subscribed power of the meter
+_connections: dict[str, tuple[sqlite3.Connection, int]] = {}
+
+
+def _connection(path: str) -> tuple[sqlite3.Connection, int]:
+    if path not in _connections:
+        conn = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+        maintenance.configure(conn, "reader")
+        archive.register(conn)
+        meter_info = json.loads(conn.execute("SELECT value FROM config WHERE key = 'meter_info'").fetchone()[0])
+        _connections[path] = (conn, myelectricaldata.subscribed_power(meter_info))
+    return _connections[path]
+
+
+def _list_months(path: str) -> list[tuple[str, int, int]]:
+    conn, _ = _connection(path)
+    return [(path, year, month) for year, month in
+            conn.execute("SELECT year, month FROM consumption GROUP BY year, month "
+                         "UNION SELECT year, month FROM consumption_archive ORDER BY year, month").fetchall()]
+
+
+def _price_partition(args: tuple[str, int, int, tuple[str, ...], str]) -> tuple[str, list[tuple]]:
+    """
+    Gives the daily rows of `query_plan_prices_period` for one month of one meter.
+    """
+    path, year, month, plans, price_mode = args
+    conn, power = _connection(path)
+    query = query_plan_prices_period(list(map(EdfPlan, plans)), price_mode)
+    params = query_params(date(year, month, 1), date(year, month, monthrange(year, month)[1]), power)
+    return path, conn.execute(query, params).fetchall()
+
+
+def _reduce(rows: list[tuple], key: Callable[[str], str], n_plans: int, with_total: bool) -> list[tuple]:
+    """
+    Sums daily rows into periods, like the GROUP BY and the `Total` row of `query_plan_prices_period` would.
+    """
+    groups: dict[str, list] = {}
+    for day, *sums in rows:
+        acc = groups.setdefault(key(day), [0] * (1 + n_plans))
+        for i, v in enumerate(sums):
+            acc[i] += v
+    res = [(k, *groups[k]) for k in sorted(groups)]
+    if with_total:
+        # SUM over no rows is NULL
+        totals = [sum(col) for col in zip(*[r[1:] for r in res])] if res else [None] * (1 + n_plans)
+        res.append(("Total", *totals))
+    return res
+
+
+def query_plan_prices_partitioned(db_paths: list[str], plans: list[EdfPlan] = EdfPlan, price_mode="real",
+                                  period="mensuel", with_total: bool = False,
+                                  months: Optional[Callable[[int, int], bool]] = None,
+                                  workers: Optional[int] = None) -> dict[str, list[tuple]]:
+    """
+    Computes the rows `query_plan_prices_period` would give for each of the `db_paths` databases, grouped by
+    `period` (one of `PERIOD_KEYS`).
+
+    The work is split by meter and by month, and the partitions are spread over a pool of `workers` processes that
+    each open their own read-only connections. `months`, if given, selects the (year, month) partitions to compute.
+    """
+    plan_values = tuple(p.value for p in plans)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        partitions = [(path, year, month, plan_values, price_mode)
+                      for listed in pool.map(_list_months, db_paths)
+                      for path, year, month in listed
+                      if months is None or months(year, month)]
+        chunksize = max(1, len(partitions) // (4 * workers))
+        daily: dict[str, list[tuple]] = {path: [] for path in db_paths}
+        for path, rows in pool.map(_price_partition, partitions, chunksize=chunksize):
+            daily[path].extend(rows)
+
+    return {path: _reduce(rows, PERIOD_KEYS[period], len(plans), with_total) for path, rows in daily.items()}
@@ -0,0 +1,83 @@
+# coding: utf-8
+from typing import Optional
+
+import numpy as np
+
+import db
+from edf_plan import EdfPlan
+from history import History
+
+
+def plan_rates(plan: EdfPlan, days: np.ndarray, price_mode="real", power: Optional[int] = None) -> np.ndarray:
+    """
+    Gives a (3, 4, n) array of the rates of `plan` for each of the n `days` and each day kind (0-3):
+    - [0]: HP price in 1/10000 €/kWh
+    - [1]: HC price in 1/10000 €/kWh
+    - [2]: yearly subscription in 1/100 €
+
+    Rates that are unknown are NaN. `price_mode` has the same meaning as in `query_plan_prices_bihourly`.
+    """
+    rows = db.cur.execute(
+        "SELECT day_kind, kwh_hp, kwh_hc, subscription, start, end FROM edf_plan_slice "
+        "WHERE plan_id = ? AND power = ? ORDER BY start",
+        (plan.value, db.sub_power if power is None else power)).fetchall()
+    rates = np.full((3, 4, len(days)), np.nan)
+    for day_kind, kwh_hp, kwh_hc, subscription, start, end in rows:
+        match price_mode:
+            case "real":
+                mask = (np.datetime64(start) <= days) & (days <= np.datetime64(end))
+            case "current":
+                # rows are sorted by start, so the last one wins
+                mask = slice(None)
+            case _:
+                raise NotImplementedError(price_mode)
+        rates[:, day_kind, mask] = np.array([kwh_hp, kwh_hc, subscription])[:, None]
+    return rates
+
+
+def slice_prices(plan: EdfPlan, history: History, price_mode="real", power: Optional[int] = None) \
+        -> tuple[np.ndarray, np.ndarray]:
+    """
+    Gives two (n, 48) arrays for the days of `history`:
+    - the price of each slice in 1/10000 €/kWh
+    - the share of the subscription billed for each slice in 1/10000000 €
+
+    Both are NaN where the rates are unknown.
+    """
+    rates = plan_rates(plan, history.days, price_mode, power)
+    n = len(history)
+    day_idx = np.arange(n)[:, None]
+    kinds = plan.day_kinds(history.days, history.tempo)
+    if kinds is None:
+        kinds = np.zeros((n, 48), dtype=np.int64)
+    hp = plan.hp_slices()
+    if hp is None:
+        hp = np.zeros(48, dtype=bool)
+    prices = np.where(hp, rates[0][kinds, day_idx], rates[1][kinds, day_idx])
+
+    month_start = history.days.astype("datetime64[M]")
+    days_in_month = ((month_start + 1).astype("datetime64[D]") - month_start.astype("datetime64[D]")).astype(np.int64)
+    # same integer divisions as in SQL
+    subscription = rates[2][kinds, day_idx] * 100000 // 12 // days_in_month[:, None] // 48
+    return prices, subscription
+
+
+def slice_costs(plan: EdfPlan, history: History, price_mode="real", power: Optional[int] = None,
+                prices: Optional[tuple[np.ndarray, np.ndarray]] = None) -> np.ndarray:
+    """
+    Gives the (n, 48) array of the cost of each slice of `history` in 1/10000000 €. Counterpart of the `eur_{plan}`
+    columns of `query_plan_prices_bihourly`: slices without consumption are NaN, slices with unknown rates are +inf.
+
+    `prices` can be given to reuse the result of `slice_prices`.
+    """
+    kwh, subscription = prices if prices is not None else slice_prices(plan, history, price_mode, power)
+    costs = np.nan_to_num(kwh * history.values + subscription, nan=np.inf)
+    costs[np.isnan(history.values)] = np.nan
+    return costs
+
+
+def total_cost(costs: np.ndarray) -> float:
+    """
+    Sums slice costs the way SQL's SUM would: missing slices are skipped, unknown rates make the total infinite.
+    """
+    return float(np.nansum(costs))
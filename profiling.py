@@ -0,0 +1,248 @@
+# coding: utf-8
+import asyncio
+import contextvars
+import functools
+import inspect
+import itertools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from config import config
+
+# On-demand profiling of UI events and ingestion. While enabled, each profiled call is sampled from a background
+# thread, giving stacks that can be turned into a flame graph, and its allocations are traced. Turned on from startup
+# with `PROFILING=1`, or at runtime from the /profiling page. When disabled, the wrappers only check a flag.
+
+# profiles kept, the oldest being dropped
+KEEP = int(config.get("PROFILING_KEEP") or 20)
+
+# time between two samples
+INTERVAL = float(config.get("PROFILING_INTERVAL_MS") or 1) / 1000
+
+# lines whose allocations are reported for each profile
+TOP_ALLOCATIONS = 15
+
+# longest a UI event's profile waits for the resulting updates to be sent to the browser
+EMIT_TIMEOUT = 1.0
+
+enabled = False
+
+profiles: deque["Profile"] = deque(maxlen=KEEP)
+
+_ids = itertools.count(1)
+
+# task (or thread, outside of tasks) running a profile in the current context, so that nested profiled calls are part
+# of the outer one; tasks started meanwhile inherit the context but not the ownership, and get their own profiles
+_active = contextvars.ContextVar("profiling_active", default=None)
+
+# sessions not stopped yet, in any context
+_running: set["Session"] = set()
+
+
+@dataclass
+class Profile:
+    id: int
+    name: str
+    started: datetime
+    duration: float = 0.0
+    # folded stacks ("outer;...;inner") -> number of samples
+    samples: Counter = field(default_factory=Counter)
+    # (file:line, size change in bytes, allocation count change), biggest first
+    allocations: list[tuple[str, int, int]] = field(default_factory=list)
+    # highest traced memory above the level at the start, in bytes; None when other profiles ran at the same time,
+    # since the traced peak is shared by all of them
+    peak: Optional[int] = 0
+
+    def folded(self) -> str:
+        """
+        Gives the samples in the folded stack format read by flamegraph.pl, speedscope and most flame graph tools.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+def enable(on: bool = True):
+    global enabled
+    if on and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not on and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = on
+
+
+def _owner():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task if task is not None else threading.current_thread()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Session:
+    """
+    A running profile, sampling the thread that started it.
+    """
+
+    def __init__(self, name: str):
+        self.profile = Profile(next(_ids), name, datetime.now())
+        self.thread = threading.get_ident()
+        self.done = threading.Event()
+        self.token = _active.set(_owner())
+        self.before = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if self.before is not None:
+            self.base = tracemalloc.get_traced_memory()[0]
+        # the peak of the sessions already running would be lost by resetting it
+        self.shared_peak = bool(_running)
+        for other in _running:
+            other.shared_peak = True
+        if self.before is not None and not self.shared_peak:
+            tracemalloc.reset_peak()
+        _running.add(self)
+        self.start = time.perf_counter()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.done.wait(INTERVAL):
+            frame = sys._current_frames().get(self.thread)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self.profile.samples[";".join(reversed(stack))] += 1
+
+    def detach(self):
+        """
+        Lets calls made in the current context from now on start their own profiles, for sessions that outlive the
+        call that started them.
+        """
+        if self.token is not None:
+            _active.reset(self.token)
+            self.token = None
+
+    def stop(self):
+        if self.done.is_set():
+            return
+        self.done.set()
+        self.profile.duration = time.perf_counter() - self.start
+        self.sampler.join()
+        self.detach()
+        _running.discard(self)
+        if self.before is not None and tracemalloc.is_tracing():
+            self.profile.peak = None if self.shared_peak else tracemalloc.get_traced_memory()[1] - self.base
+            after = tracemalloc.take_snapshot().filter_traces([
+                # the samples themselves
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ])
+            self.profile.allocations = [
+                (f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", stat.size_diff, stat.count_diff)
+                for stat in after.compare_to(self.before, "lineno")[:TOP_ALLOCATIONS]]
+        profiles.append(self.profile)
+
+
+def start(name: str) -> Optional[Session]:
+    """
+    Starts profiling, unless profiling is disabled or a profile is already running in the current task.
+    """
+    if not enabled or _active.get() is _owner():
+        return None
+    return Session(name)
+
+
+def profiled(f):
+    """
+    Profiles each call of `f`, a function or a coroutine function. For a coroutine, the samples cover everything the
+    event loop runs until it returns, other tasks included.
+    """
+    name = f.__qualname__
+    if inspect.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            if not enabled:
+                return await f(*args, **kwargs)
+            session = start(name)
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                if session is not None:
+                    session.stop()
+    else:
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            session = start(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if session is not None:
+                    session.stop()
+    return wrapper
+
+
+def get(profile_id: int) -> Optional[Profile]:
+    return next((p for p in profiles if p.id == profile_id), None)
+
+
+def install_nicegui():
+    """
+    Profiles the handling of each event sent by the browser, from the handlers to the updates they cause being sent
+    back through the websocket. Events whose handlers queue nothing for the browser (such as async handlers that
+    update it later) are only profiled up to the handlers returning.
+    """
+    from nicegui.client import Client
+    from nicegui.outbox import Outbox
+
+    handle_event = Client.handle_event
+    emit = Outbox._emit
+    # client id -> sessions waiting for the next updates sent to the client
+    waiting: dict[str, list[Session]] = {}
+
+    def finish(client_id: str, session: Session):
+        if session in (sessions := waiting.get(client_id, [])):
+            sessions.remove(session)
+        session.stop()
+
+    @functools.wraps(handle_event)
+    def profiled_handle_event(self, msg: dict):
+        if not enabled:
+            return handle_event(self, msg)
+        sender = self.elements.get(msg.get("id"))
+        listener = getattr(sender, "_event_listeners", {}).get(msg.get("listener_id"))
+        session = start(f"{type(sender).__name__}.{listener.type if listener else 'event'}")
+        try:
+            return handle_event(self, msg)
+        finally:
+            if session is not None:
+                if not self.outbox.updates and not self.outbox.messages:
+                    # nothing to send, the next emit wouldn't be this event's
+                    session.stop()
+                else:
+                    session.detach()
+                    waiting.setdefault(self.id, []).append(session)
+                    asyncio.get_running_loop().call_later(EMIT_TIMEOUT, finish, self.id, session)
+
+    @functools.wraps(emit)
+    async def profiled_emit(self, message_type, data, target_id):
+        await emit(self, message_type, data, target_id)
+        for session in waiting.pop(target_id, []):
+            session.stop()
+
+    Client.handle_event = profiled_handle_event
+    Outbox._emit = profiled_emit
+
+
+enable(config.get("PROFILING") == "1")
@@ -0,0 +1,168 @@
+# coding: utf-8
+import argparse
+import asyncio
+import csv
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Iterator
+
+from edf_plan import EdfPlan, query_plan_prices_period, query_params
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("meters", nargs="+",
+                        help="app.db files or directories containing app.db and .env (or meter ids, with --root)")
+    parser.add_argument("--root", type=Path, help="directory containing one subdirectory per meter id")
+    parser.add_argument("--output", "-o", type=Path, default=Path("report.json"), help="output file (.json or .csv)")
+    parser.add_argument("--workers", type=int, default=None, help="number of meters processed at once")
+    parser.add_argument("--no-fetch", action="store_true", help="don't fetch new data, only price what's stored")
+    parser.add_argument("--current-plan", choices=[p.value for p in EdfPlan], default=EdfPlan.BASE.value,
+                        help="plan the savings are computed against")
+    parser.add_argument("--price-mode", choices=["real", "current"], default="real")
+
+
+def meter_directory(meter: str, root: Path = None) -> Path:
+    """
+    Gives the directory holding the app.db and .env files of `meter`.
+    """
+    path = Path(meter)
+    if not path.exists() and root is not None:
+        path = root / meter
+    if path.is_file():
+        if path.name != "app.db":
+            raise ValueError(f"{path}: the database must be named app.db")
+        path = path.parent
+    if not (path / "app.db").is_file():
+        raise FileNotFoundError(f"{path}: no app.db found")
+    return path.resolve()
+
+
+def fresh_processes(f: Callable, calls: dict[str, tuple], workers: int = None) -> Iterator[tuple[str, Future]]:
+    """
+    Runs `f(*args)` for each name -> args of `calls`, each in a new spawned process so that it gets its own fresh
+    `db` and `config` modules, `workers` (the number of CPUs by default) at a time. Yields the name and future of each
+    call as it completes.
+    """
+    workers = workers or os.cpu_count() or 1
+    context = multiprocessing.get_context("spawn")
+    pending = list(calls.items())
+    # a single-worker pool per call, since pools only recycle their workers from Python 3.11
+    running: dict[Future, tuple[str, ProcessPoolExecutor]] = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                name, args = pending.pop(0)
+                pool = ProcessPoolExecutor(1, mp_context=context)
+                running[pool.submit(f, *args)] = name, pool
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, pool = running.pop(future)
+                pool.shutdown()
+                yield name, future
+    finally:
+        for name, pool in running.values():
+            pool.shutdown(cancel_futures=True)
+
+
+def summarize(rows: list[tuple], plans: list[EdfPlan], current_plan: EdfPlan) -> list[dict]:
+    """
+    Turns the rows of `query_plan_prices_period` into per-period summaries with the cheapest plan and the savings it
+    brings compared to `current_plan`. Costs are in €, None where the prices are unknown.
+    """
+    res = []
+    for period, value, *costs in rows:
+        costs = {p.value: None if c is None or math.isinf(c) else c / 10000000 for p, c in zip(plans, costs)}
+        known = {p: c for p, c in costs.items() if c is not None}
+        cheapest = min(known, key=known.get) if known else None
+        current = costs.get(current_plan.value)
+        res.append({
+            "period": period,
+            "kwh": value / 1000 if value is not None else None,
+            "costs": costs,
+            "cheapest": cheapest,
+            "savings": current - known[cheapest] if cheapest is not None and current is not None else None,
+        })
+    return res
+
+
+def _report_meter(directory: str, fetch: bool, current_plan: str, price_mode: str) -> dict:
+    """
+    Runs in a fresh worker process: the `db` and `config` modules bind to the app.db and .env files of the current
+    directory when they are imported, so each process handles a single meter.
+    """
+    os.chdir(directory)
+    # importing main.py to parse the arguments already loaded the settings of the former directory
+    import config
+    config.load()
+
+    import db
+    asyncio.run(db.load_meter_info())
+    if fetch:
+        import fetch_edf
+        fetch_edf.log_callback = lambda *args: None
+        asyncio.run(fetch_edf.fetch_loop())
+
+    plans = list(EdfPlan)
+    rows = db.cur.execute(query_plan_prices_period(plans, price_mode, "strftime('%Y-%m', c.date)", with_total=True),
+                          query_params()).fetchall()
+    return {
+        "meter": Path(directory).name,
+        "power": db.sub_power,
+        "months": summarize(rows, plans, EdfPlan(current_plan)),
+    }
+
+
+def write_json(reports: list[dict], output: Path):
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2)
+
+
+def write_csv(reports: list[dict], output: Path):
+    with open(output, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["meter", "period", "kwh", *(f"eur_{p.value}" for p in EdfPlan), "cheapest", "savings",
+                         "error"])
+        for report in reports:
+            if "error" in report:
+                writer.writerow([report["meter"], *[""] * (4 + len(EdfPlan)), report["error"]])
+                continue
+            for month in report["months"]:
+                writer.writerow([report["meter"], month["period"], month["kwh"],
+                                 *(month["costs"][p.value] for p in EdfPlan), month["cheapest"], month["savings"], ""])
+
+
+def run(args: argparse.Namespace):
+    directories = {}
+    for meter in args.meters:
+        try:
+            directories[meter] = str(meter_directory(meter, args.root))
+        except (ValueError, FileNotFoundError) as e:
+            print(e, file=sys.stderr)
+
+    start = time.perf_counter()
+    reports = []
+    calls = {Path(directory).name: (directory, not args.no_fetch, args.current_plan, args.price_mode)
+             for directory in directories.values()}
+    for name, future in fresh_processes(_report_meter, calls, args.workers):
+        try:
+            reports.append(future.result())
+        except Exception as e:
+            reports.append({"meter": name, "error": repr(e)})
+            print(name, e, file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    reports.sort(key=lambda r: r["meter"])
+    if args.output.suffix == ".csv":
+        write_csv(reports, args.output)
+    else:
+        write_json(reports, args.output)
+
+    failed = sum("error" in r for r in reports)
+    print(f"{len(reports) - failed} meters priced, {failed} failed, in {elapsed:.1f} s "
+          f"({len(reports) / elapsed * 60 if elapsed else 0:.1f} meters/min), written to {args.output}")
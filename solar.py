@@ -0,0 +1,165 @@
+# coding: utf-8
+import io
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import pricing
+from edf_plan import EdfPlan
+from history import History
+
+
+@dataclass
+class Battery:
+    capacity: float  # Wh
+    max_power: float  # W, both when charging and discharging
+    efficiency: float = 0.9  # round trip
+    initial_charge: float = 0  # Wh
+
+
+@dataclass
+class SolarResult:
+    """
+    Outcome of a simulation, as (n, 48) arrays in Wh (NaN where no consumption reading was stored):
+    - grid_import: energy drawn from the grid
+    - grid_export: surplus sent to the grid
+    - charge: state of charge of the battery at the end of each slice
+    """
+    grid_import: np.ndarray
+    grid_export: np.ndarray
+    charge: np.ndarray
+
+    def self_consumption(self, production: np.ndarray) -> float:
+        """
+        Gives the share of the production that was used on site rather than exported.
+        """
+        produced = np.nansum(np.where(np.isnan(self.grid_export), 0, production))
+        return 1 - np.nansum(self.grid_export) / produced if produced else float("nan")
+
+
+def _dst(days: np.ndarray) -> np.ndarray:
+    """
+    Gives whether French summer time applies on each day (last Sunday of March to last Sunday of October).
+    """
+    years = days.astype("datetime64[Y]")
+
+    def last_sunday(month_end):
+        # 1970-01-01 was a Thursday
+        return month_end - ((month_end.astype(np.int64) + 3 - 6) % 7)
+
+    return ((last_sunday(years + np.timedelta64(2, "M") + np.timedelta64(30, "D")) <= days)
+            & (days < last_sunday(years + np.timedelta64(9, "M") + np.timedelta64(30, "D"))))
+
+
+def clear_sky_production(days: np.ndarray, peak_power: float, latitude: float = 46.5, longitude: float = 2.5,
+                         performance_ratio: float = 0.75) -> np.ndarray:
+    """
+    Gives a synthetic (n, 48) production profile in Wh for a PV installation of `peak_power` Wc, from the sun's
+    elevation at the middle of each slice. Clouds and panel orientation are ignored, so this is an upper bound.
+    """
+    day_of_year = (days - days.astype("datetime64[Y]")).astype(np.int64) + 1
+    declination = np.radians(23.44) * np.sin(2 * np.pi * (284 + day_of_year) / 365)
+    utc_offset = np.where(_dst(days), 2, 1)
+    solar_hour = (np.arange(48) + 0.5) / 2 - utc_offset[:, None] + longitude / 15
+    hour_angle = np.radians(15 * (solar_hour - 12))
+    lat = np.radians(latitude)
+    sin_elevation = (np.sin(lat) * np.sin(declination)[:, None]
+                     + np.cos(lat) * np.cos(declination)[:, None] * np.cos(hour_angle))
+    return peak_power * performance_ratio * np.maximum(sin_elevation, 0) / 2
+
+
+def production_from_csv(content: str, days: np.ndarray) -> np.ndarray:
+    """
+    Reads a production series from a CSV file whose first column is the start of each half-hour (ISO format) and
+    second column the energy produced in Wh, and lays it out over `days`. Slices absent from the file produce nothing.
+    Times with a UTC offset are converted to French time, the one the slices are in; the others are taken as is.
+    """
+    production = np.zeros(len(days) * 48)
+    if not len(days):
+        return production.reshape(-1, 48)
+    df = pd.read_csv(io.StringIO(content), sep=None, engine="python")
+    column = df.iloc[:, 0].astype(str).str.strip()
+    if column.str.contains(r"(?:Z|[+-]\d\d:?\d\d)$").any():
+        stamps = pd.to_datetime(column, format="ISO8601", utc=True).dt.tz_convert("Europe/Paris").dt.tz_localize(None)
+    else:
+        stamps = pd.to_datetime(column, format="ISO8601")
+    stamps = stamps.to_numpy()
+    idx = (stamps.astype("datetime64[m]") - days[0].astype("datetime64[m]")).astype(np.int64) // 30
+    mask = (0 <= idx) & (idx < len(production))
+    production[idx[mask]] = df.iloc[:, 1].to_numpy(dtype=np.float64)[mask]
+    return production.reshape(-1, 48)
+
+
+def _clamped_cumsum(delta: np.ndarray, upper: np.ndarray, initial: np.ndarray) -> np.ndarray:
+    """
+    Computes x[t] = clip(x[t - 1] + delta[t], 0, upper) along the last axis, starting from x[-1] = initial.
+
+    Each step is a function x -> clip(x + a, lo, hi), and these compose into functions of the same form, so all the
+    prefixes are computed with a Hillis-Steele scan in log2(n) vectorized passes.
+    """
+    a = delta.copy()
+    lo = np.zeros_like(delta)
+    hi = np.broadcast_to(upper, delta.shape).copy()
+    step = 1
+    while step < delta.shape[-1]:
+        # compose the prefix ending `step` slices earlier with the current one
+        pa, plo, phi = a[..., :-step], lo[..., :-step], hi[..., :-step]
+        ca, clo, chi = a[..., step:], lo[..., step:], hi[..., step:]
+        new_lo = np.clip(plo + ca, clo, chi)
+        new_hi = np.clip(phi + ca, clo, chi)
+        a[..., step:] = pa + ca
+        lo[..., step:], hi[..., step:] = new_lo, new_hi
+        step *= 2
+    return np.clip(np.asarray(initial)[..., None] + a, lo, hi)
+
+
+def simulate(history: History, production: np.ndarray, battery: Optional[Battery] = None) -> SolarResult:
+    """
+    Runs the installation over every slice of `history`: the production first covers the consumption, the surplus
+    charges the battery, and the battery then covers what's left of the consumption, within its power limits.
+    """
+    batteries = simulate_sweep(history, production, [battery or Battery(0, 0)])
+    return SolarResult(batteries.grid_import[0], batteries.grid_export[0], batteries.charge[0])
+
+
+def simulate_sweep(history: History, production: np.ndarray, batteries: list[Battery]) -> SolarResult:
+    """
+    Same as `simulate` for several batteries at once; the result arrays get a leading axis, one entry per battery.
+    """
+    missing = np.isnan(history.values).reshape(-1)
+    net = np.where(missing, 0, history.values.reshape(-1) - production.reshape(-1))
+
+    capacity = np.array([b.capacity for b in batteries], dtype=np.float64)[:, None]
+    per_slice = np.array([b.max_power for b in batteries], dtype=np.float64)[:, None] / 2
+    one_way = np.sqrt([b.efficiency for b in batteries])[:, None]
+    initial = np.array([b.initial_charge for b in batteries], dtype=np.float64)
+
+    # energy stored (positive) or drawn (negative) if the battery were neither full nor empty
+    wanted = np.where(net < 0, np.minimum(-net, per_slice) * one_way, -np.minimum(net, per_slice) / one_way)
+    charge = _clamped_cumsum(wanted, capacity, initial)
+    stored = np.diff(charge, axis=-1, prepend=initial[:, None])
+
+    grid = net + np.where(stored > 0, stored / one_way, stored * one_way)
+    grid_import = np.maximum(grid, 0)
+    grid_export = np.maximum(-grid, 0)
+    grid_import[:, missing] = np.nan
+    grid_export[:, missing] = np.nan
+    shape = (len(batteries), *history.values.shape)
+    return SolarResult(grid_import.reshape(shape), grid_export.reshape(shape), charge.reshape(shape))
+
+
+def sweep_costs(history: History, production: np.ndarray, batteries: list[Battery], plans: list[EdfPlan] = EdfPlan,
+                price_mode="real") -> dict[EdfPlan, np.ndarray]:
+    """
+    Gives, for each plan, the total cost in 1/10000000 € of the grid import with each of `batteries`.
+    """
+    result = simulate_sweep(history, production, batteries)
+    res = {}
+    for plan in plans:
+        prices = pricing.slice_prices(plan, history, price_mode)
+        res[plan] = np.array([
+            pricing.total_cost(pricing.slice_costs(plan, history.with_values(grid_import), prices=prices))
+            for grid_import in result.grid_import])
+    return res
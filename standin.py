@@ -0,0 +1,326 @@
+# coding: utf-8
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from apis import datagouvfr, myelectricaldata, tempo
+
+# Local stand-in for the MyElectricalData, api-couleur-tempo and data.gouv.fr APIs, to exercise ingestion without the
+# live services. Point the `MED_API_ROOT`, `TEMPO_API_ROOT` and `DATA_GOUV_ROOT` settings to the `/med`, `/tempo` and
+# `/datagouv` prefixes of the server (see `roots`).
+#
+# Responses are synthetic (deterministic for a given meter id and day), or replayed from a directory recorded by
+# running the server in record mode in front of the live services. Latency, errors and rate limits are simulated on
+# top of either.
+
+PREFIXES = {"med": "/med", "tempo": "/tempo", "datagouv": "/datagouv"}
+
+UPSTREAMS = {
+    "med": myelectricaldata.MED_ROOT,
+    "tempo": tempo.TEMPO_ROOT,
+    "datagouv": datagouvfr.DATA_GOUV_ROOT,
+}
+
+# meter ids are replaced by this in the recording keys, so that a recording can be replayed for any meter
+METER_PLACEHOLDER = "{meter}"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8130)
+    add_behavior_arguments(parser)
+
+
+def add_behavior_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.0, help="fixed part of the response time, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="mean of the random (exponentially distributed) part of the response time, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests answered with a 503")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="requests per second allowed per client and service before answering 429 (0: no limit)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--record", type=Path, help="forward to the live APIs and save the responses to this directory")
+    mode.add_argument("--replay", type=Path,
+                      help="serve the responses saved to this directory (synthetic ones for what wasn't recorded)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the simulated latency and errors")
+
+
+def roots(base_url: str) -> dict[str, str]:
+    """
+    Gives the settings that point the API clients to a stand-in server listening at `base_url`.
+    """
+    return {
+        "MED_API_ROOT": base_url + PREFIXES["med"],
+        "TEMPO_API_ROOT": base_url + PREFIXES["tempo"],
+        "DATA_GOUV_ROOT": base_url + PREFIXES["datagouv"],
+    }
+
+
+def _day_random(*key) -> random.Random:
+    return random.Random(hashlib.sha256(repr(key).encode()).digest())
+
+
+def synthetic_load_curve(meter: str, day: date) -> list[int]:
+    """
+    Gives the 48 average powers (W) of a day, shaped like a household's: a base load, morning and evening peaks, and
+    more in winter.
+    """
+    rng = _day_random(meter, day)
+    winter = 1 + 0.8 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 15) / 365)
+    base = 200 + _day_random(meter).randint(0, 300)
+    values = []
+    for slice_idx in range(48):
+        hour = slice_idx / 2
+        shape = 1 + 1.5 * math.exp(-((hour - 7.5) / 1.5) ** 2) + 2.5 * math.exp(-((hour - 19.5) / 2) ** 2)
+        values.append(int(base * winter * shape * rng.uniform(0.7, 1.3)))
+    return values
+
+
+def synthetic_tempo(day: date) -> int:
+    """
+    Gives a Tempo colour (1 blue, 2 white, 3 red) for a past day: red and white days fall on winter weekdays, never on
+    Sundays.
+    """
+    if day.weekday() == 6:
+        return 1
+    roll = _day_random("tempo", day).random()
+    if day.month in (11, 12, 1, 2, 3):
+        return 3 if roll < 0.15 and day.weekday() < 5 else 2 if roll < 0.4 else 1
+    return 2 if roll < 0.1 else 1
+
+
+def _dmy(d: date) -> str:
+    return d.strftime("%d/%m/%Y")
+
+
+def synthetic_tariff_csv(plan: str) -> str:
+    """
+    Gives a regulated tariff history in the format of the data.gouv.fr datasets.
+    """
+    powers = (3, 6, 9, 12, 15, 18, 24, 30, 36)
+    periods = ((date(2022, 2, 1), date(2023, 1, 31), 1.0), (date(2023, 2, 1), None, 1.15))
+    if plan == "base":
+        rows = ["DATE_DEBUT;DATE_FIN;P_SOUSCRITE;PART_FIXE_HT;PART_FIXE_TTC;PART_VARIABLE_HT;PART_VARIABLE_TTC"]
+    else:
+        rows = ["DATE_DEBUT;DATE_FIN;P_SOUSCRITE;PART_FIXE_HT;PART_FIXE_TTC;PART_VARIABLE_HC_HT;PART_VARIABLE_HC_TTC;"
+                "PART_VARIABLE_HP_HT;PART_VARIABLE_HP_TTC"]
+    for start, end, factor in periods:
+        for power in powers:
+            fixed = f"{(50 + 15 * power) * factor:.2f}".replace(".", ",")
+            columns = [_dmy(start), _dmy(end) if end else "", str(power), fixed, fixed]
+            if plan == "base":
+                variable = f"{0.17 * factor:.4f}".replace(".", ",")
+                columns += [variable, variable]
+            else:
+                hc = f"{0.13 * factor:.4f}".replace(".", ",")
+                hp = f"{0.20 * factor:.4f}".replace(".", ",")
+                columns += [hc, hc, hp, hp]
+            rows.append(";".join(columns))
+    return "\n".join(rows) + "\n"
+
+
+def _date_range(start: str, end: str) -> list[date]:
+    start, end = date.fromisoformat(start), date.fromisoformat(end)
+    return [start + timedelta(days=i) for i in range((end - start).days)]
+
+
+def synthetic_med(endpoint: str, meter: str, start: Optional[str], end: Optional[str]) -> Optional[dict]:
+    """
+    Gives a synthetic MyElectricalData response, None for unknown endpoints. Days from today on have no data, as with
+    the live API.
+    """
+    if endpoint == "contracts":
+        return {"customer": {"usage_points": [{"contracts": {
+            "subscribed_power": f"{_day_random(meter).choice((6, 9, 12))} kVA",
+            "last_activation_date": f"{date.today().year - 3}-01-01+01:00",
+        }}]}}
+    if start is None or end is None:
+        return None
+    days = [d for d in _date_range(start, end) if d < date.today()]
+    match endpoint:
+        case "consumption_load_curve":
+            # readings are dated by the end of their slice
+            readings = [{"value": str(value), "date": str(datetime.combine(d, datetime.min.time())
+                                                          + timedelta(minutes=30 * (i + 1))),
+                         "interval_length": "PT30M", "measure_type": "B"}
+                        for d in days for i, value in enumerate(synthetic_load_curve(meter, d))]
+        case "daily_consumption":
+            readings = [{"value": str(sum(synthetic_load_curve(meter, d)) // 2), "date": d.isoformat()} for d in days]
+        case "daily_consumption_max_power":
+            readings = []
+            for d in days:
+                curve = synthetic_load_curve(meter, d)
+                peak = max(range(48), key=curve.__getitem__)
+                readings.append({"value": str(int(curve[peak] * 1.4)),
+                                 "date": str(datetime.combine(d, datetime.min.time()) + timedelta(minutes=30 * peak))})
+        case _:
+            return None
+    return {"meter_reading": {"usage_point_id": meter, "start": start, "end": end, "quality": "BRUT",
+                              "reading_type": {"unit": "W" if endpoint != "daily_consumption" else "Wh"},
+                              "interval_reading": readings}}
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        # at least one whole token, so that rates below one request per second still let requests through
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class StandIn:
+    """
+    The request handlers of the stand-in server, with the counters of what was served.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, rate_limit: float = 0.0,
+                 record: Optional[Path] = None, replay: Optional[Path] = None, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.record = record
+        self.replay = replay
+        self.random = random.Random(seed)
+        self.buckets: dict[tuple[str, str], TokenBucket] = {}
+        # (service, status) -> count
+        self.served: Counter = Counter()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "StandIn":
+        return cls(args.latency, args.jitter, args.error_rate, args.rate_limit, args.record, args.replay, args.seed)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get(PREFIXES["med"] + "/{endpoint}/{meter}/cache/", self.med),
+            web.get(PREFIXES["med"] + "/{endpoint}/{meter}/start/{start}/end/{end}/cache/", self.med),
+            web.get(PREFIXES["tempo"] + "/api/joursTempo", self.tempo),
+            web.get(PREFIXES["datagouv"] + "/fr/datasets/r/{resource}", self.datagouv),
+            web.get("/stats", self.stats),
+        ])
+        app.on_cleanup.append(self.close)
+        return app
+
+    async def close(self, app: web.Application):
+        if self.session is not None:
+            await self.session.close()
+
+    async def simulate(self, service: str, request: web.Request) -> Optional[web.Response]:
+        """
+        Waits for the simulated latency, then gives the error response to send instead of the real one, if any.
+        """
+        delay = self.latency + (self.random.expovariate(1 / self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.rate_limit:
+            client = request.headers.get("Authorization") or request.remote or ""
+            bucket = self.buckets.setdefault((service, client), TokenBucket(self.rate_limit))
+            if not bucket.take():
+                return web.json_response({"detail": "Too many requests"}, status=429)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"detail": "Service unavailable"}, status=503)
+        return None
+
+    def recording_path(self, directory: Path, service: str, key: str) -> Path:
+        return directory / service / (hashlib.sha256(key.encode()).hexdigest()[:32] + ".json")
+
+    async def respond(self, service: str, request: web.Request, key: str, synthetic) -> web.Response:
+        """
+        Answers `request`, identified by `key` (its path and query without the meter id), with the simulated error,
+        the recorded response or the synthetic one given by calling `synthetic`.
+        """
+        response = await self.simulate(service, request)
+        if response is None:
+            if self.record is not None:
+                response = await self.forward(service, request, key)
+            elif self.replay is not None and (path := self.recording_path(self.replay, service, key)).is_file():
+                saved = json.loads(path.read_text("utf-8"))
+                body = saved["body"].replace(METER_PLACEHOLDER, request.match_info.get("meter", ""))
+                response = web.Response(text=body, status=saved["status"], content_type=saved["content_type"])
+            elif (res := synthetic()) is None:
+                response = web.json_response({"detail": "Not found"}, status=404)
+            elif isinstance(res, str):
+                response = web.Response(text=res, content_type="text/csv")
+            else:
+                response = web.json_response(res)
+        self.served[service, response.status] += 1
+        return response
+
+    async def forward(self, service: str, request: web.Request, key: str) -> web.Response:
+        """
+        Gets the response from the live API and saves it, with the meter id made generic.
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        url = UPSTREAMS[service] + request.path_qs.removeprefix(PREFIXES[service])
+        headers = {"Authorization": request.headers["Authorization"]} if "Authorization" in request.headers else {}
+        async with self.session.get(url, headers=headers) as upstream:
+            body = await upstream.text("utf-8")
+            content_type = upstream.content_type
+            status = upstream.status
+        if status == 200:
+            path = self.recording_path(self.record, service, key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            meter = request.match_info.get("meter")
+            path.write_text(json.dumps({
+                "key": key, "status": status, "content_type": content_type,
+                "body": body.replace(meter, METER_PLACEHOLDER) if meter else body,
+            }), "utf-8")
+        return web.Response(text=body, status=status, content_type=content_type)
+
+    async def med(self, request: web.Request) -> web.Response:
+        info = request.match_info
+        key = request.path.removeprefix(PREFIXES["med"]).replace(f"/{info['meter']}/", f"/{METER_PLACEHOLDER}/")
+        return await self.respond("med", request, key,
+                                  lambda: synthetic_med(info["endpoint"], info["meter"], info.get("start"),
+                                                        info.get("end")))
+
+    async def tempo(self, request: web.Request) -> web.Response:
+        days = request.query.getall("dateJour[]", [])
+
+        def synthetic():
+            # days whose colour isn't known yet are given as 0
+            return [{"dateJour": d, "codeJour": synthetic_tempo(date.fromisoformat(d))
+                     if date.fromisoformat(d) <= date.today() else 0, "periode": ""} for d in days]
+
+        return await self.respond("tempo", request, "joursTempo?" + "&".join(sorted(days)), synthetic)
+
+    async def datagouv(self, request: web.Request) -> web.Response:
+        resource = request.match_info["resource"]
+        plans = {rid: plan for plan, rid in datagouvfr.TARIFF_RESOURCES.items()}
+        return await self.respond("datagouv", request, resource,
+                                  lambda: synthetic_tariff_csv(plans[resource]) if resource in plans else None)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response([{"service": service, "status": status, "count": count}
+                                  for (service, status), count in sorted(self.served.items())])
+
+
+def run(args: argparse.Namespace):
+    print(f"Stand-in APIs listening on http://{args.host}:{args.port}, use these settings:")
+    for key, value in roots(f"http://{args.host}:{args.port}").items():
+        print(f'  {key}="{value}"')
+    web.run_app(StandIn.from_args(args).app(), host=args.host, port=args.port, print=None)
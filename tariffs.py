@@ -0,0 +1,95 @@
+# coding: utf-8
+import hashlib
+import sqlite3
+from datetime import date, timedelta
+from pathlib import Path
+
+from edf_plan import EdfPlan
+
+# Prices that aren't provided by any API, copied from the public PDF price sheets. For each plan and each date the
+# prices start applying, one row per subscribed power, laid out as in the sheets:
+#   power subscription_per_month kwh...
+# with the kWh prices for each day kind in order, as HC then HP for plans that differentiate them. The numbers are
+# pasted as-is, decimal commas removed give the stored units (1/100 € per month, 1/10000 €/kWh).
+BUNDLE_PATH = Path(__file__).parent / "tariffs.json"
+
+# fetched from data.gouv.fr by `fetch_edf.fetch_prices`
+API_PLANS = {EdfPlan.BASE, EdfPlan.HPHC}
+
+# (plan_id, power, day_kind, start) -> (subscription, kwh_hp, kwh_hc, end), as in `edf_plan_slice`
+Rows = dict[tuple[str, int, int, str], tuple[int, int, int, str]]
+
+
+def bundle_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def parse_bundle(bundle: dict) -> Rows:
+    """
+    Gives the `edf_plan_slice` rows described by a tariff bundle. Raises ValueError if the bundle is malformed.
+    """
+    rows = {}
+    for plan_id, periods in bundle["plans"].items():
+        try:
+            plan = EdfPlan(plan_id)
+        except ValueError:
+            raise ValueError(f"{plan_id}: unknown plan")
+        if plan in API_PLANS:
+            raise ValueError(f"{plan_id}: prices are fetched from data.gouv.fr")
+        columns = plan.day_kind_count() * (1 if plan.is_hp_sql() is None else 2)
+        day_start = 0 if plan.day_kind_sql() is None else 1
+
+        starts = list(periods)
+        try:
+            parsed = [date.fromisoformat(s) for s in starts]
+        except ValueError as e:
+            raise ValueError(f"{plan_id}: {e}")
+        if parsed != sorted(set(parsed)):
+            raise ValueError(f"{plan_id}: periods must be in chronological order")
+        ends = [(d - timedelta(days=1)).isoformat() for d in parsed[1:]] + ["9999-12-31"]
+
+        for start, end in zip(starts, ends):
+            powers = set()
+            for line in periods[start]:
+                try:
+                    power, sub, *kwh = map(int, line.replace(",", "").split())
+                except ValueError:
+                    raise ValueError(f"{plan_id} {start}: invalid row {line!r}")
+                if len(kwh) != columns:
+                    raise ValueError(f"{plan_id} {start}: expected {columns} kWh prices, got {len(kwh)} in {line!r}")
+                if power <= 0 or sub <= 0 or min(kwh) <= 0:
+                    raise ValueError(f"{plan_id} {start}: prices must be positive in {line!r}")
+                if power in powers:
+                    raise ValueError(f"{plan_id} {start}: power {power} appears twice")
+                powers.add(power)
+                if plan.is_hp_sql() is None:
+                    prices = [(p, p) for p in kwh]
+                else:
+                    prices = [(hp, hc) for hc, hp in zip(kwh[::2], kwh[1::2])]
+                for day_kind, (hp, hc) in enumerate(prices, day_start):
+                    rows[(plan_id, power, day_kind, start)] = (12 * sub, hp, hc, end)
+    return rows
+
+
+def diff(cur: sqlite3.Cursor, rows: Rows) -> tuple[Rows, Rows, set]:
+    """
+    Compares `rows` to what's stored for the same plans. Gives the added rows, the changed rows and the keys of the
+    stored rows that are no longer in the bundle.
+    """
+    stored = {}
+    for plan in {key[0] for key in rows}:
+        for plan_id, power, day_kind, start, *values in cur.execute(
+                "SELECT plan_id, power, day_kind, start, subscription, kwh_hp, kwh_hc, end FROM edf_plan_slice "
+                "WHERE plan_id = ?", (plan,)):
+            stored[(plan_id, power, day_kind, start)] = tuple(values)
+    added = {k: v for k, v in rows.items() if k not in stored}
+    changed = {k: v for k, v in rows.items() if k in stored and stored[k] != v}
+    return added, changed, stored.keys() - rows.keys()
+
+
+def apply(cur: sqlite3.Cursor, upserted: Rows, removed: set):
+    cur.executemany("DELETE FROM edf_plan_slice WHERE plan_id = ? AND power = ? AND day_kind = ? AND start = ?",
+                    removed)
+    cur.executemany("INSERT OR REPLACE INTO edf_plan_slice "
+                    "(plan_id, power, day_kind, start, subscription, kwh_hp, kwh_hc, end) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(*k, *v) for k, v in upserted.items()])
@@ -1,4 +1,5 @@
 # coding: utf-8
+import base64
 import math
 from calendar import monthrange
 from collections import defaultdict
@@ -7,13 +8,26 @@ from datetime import date, time, timedelta, datetime
 
 import numpy as np
 import plotly.graph_objects as go
-from nicegui import ui, context
+from fastapi import HTTPException
+from fastapi.responses import PlainTextResponse
+from nicegui import ui, app, context, Client
 from plotly.subplots import make_subplots
 
+import aggregates
+import analytics
+import api
+import cohort
+import data_cache
+import db
 import fetch_edf
+import forecast
+import history
+import load_shifting
+import profiling
+import solar
 from config import config
 from db import cur, activation_date
-from edf_plan import EdfPlan, query_plan_prices_period
+from edf_plan import EdfPlan, query_plan_prices_period, query_params
 
 
 @dataclass
@@ -51,99 +65,172 @@ class YearMonthInput:
 
 tabs = []
 
+# rows of the cost table sent to the browser at once
+ROWS_PER_PAGE = 50
+
 
 def tab(name):
     def decorator(f):
-        tabs.append([name, f, None])
+        tabs.append((name, f))
         return f
 
     return decorator
 
 
-@tab("Consommation par jour")
-def content():
-    def nanmax(a):
-        # if all nan
-        if np.isnan(a).all():
-            return np.nan
-        return np.nanmax(a)
-
-    def update_plot(y, m):
-        fig.data = []
+# (client, handler) pairs that get told about new data
+change_handlers = []
+
+
+def on_data_change(handler):
+    """
+    Calls `handler` with each change ingestion commits, for as long as the current client exists.
+    """
+    change_handlers.append((context.get_client(), handler))
+
+
+def dispatch_change(change: fetch_edf.DataChange):
+    for client, handler in list(change_handlers):
+        if client.id not in Client.instances:
+            change_handlers.remove((client, handler))
+            continue
+        # the data is committed already, a failing page must not stop ingestion nor the other pages
+        try:
+            handler(change)
+        except Exception as e:
+            app.handle_exception(e)
+
+
+fetch_edf.change_callbacks.append(dispatch_change)
+
+
+# fills the heatmap figure from base64 buffers: the Tempo colour of each day (uint8, 0 when unknown) and the Wh of
+# each slice (float32, NaN when unknown). Hover labels and daily totals are derived here rather than sent.
+HEATMAP_JS = """
+function showHeatmap(id, month, tempo, values) {
+    const el = getElement(id)?.$el;
+    if (!el?._fullLayout) {
+        setTimeout(() => showHeatmap(id, month, tempo, values), 50);
+        return;
+    }
+    const decode = (data, type) => new type(Uint8Array.from(atob(data), c => c.charCodeAt(0)).buffer);
+    const colors = decode(tempo, Uint8Array);
+    const wh = decode(values, Float32Array);
+    const days = [], tempoZ = [], tempoText = [], rows = [], totals = [];
+    for (let d = 0; d < colors.length; d++) {
+        const row = wh.subarray(d * 48, d * 48 + 48);
+        let total = 0, known = false;
+        for (const v of row) {
+            if (!isNaN(v)) {
+                total += v;
+                known = true;
+            }
+        }
+        days.push(d + 1);
+        tempoZ.push([colors[d] || NaN]);
+        tempoText.push([["n/a", "Bleu", "Blanc", "Rouge"][colors[d]]]);
+        rows.push(row);
+        totals.push([known ? total / 1000 : NaN]);
+    }
+    const updates = [{z: tempoZ, text: tempoText}, {z: rows}, {z: totals}];
+    Plotly.react(el, el.data.map((trace, i) => ({...trace, ...updates[i], y: days, meta: month})), el.layout);
+}
+"""
+
+
+def encode_array(a: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(a).tobytes()).decode("ascii")
+
+
+def month_heatmap_data(y, m):
+    """
+    Gives the Tempo colour of each day of a month and its consumption in Wh as a (days, 48) array, NaN when unknown.
+    """
+    def compute():
         days_in_month = monthrange(y, m)[1]
         tempo_data_db = np.transpose(np.array(cur.execute("SELECT day, tempo FROM tempo WHERE year = ? AND month = ? ORDER BY day", (y, m)).fetchall()))
         tempo_data = np.full(days_in_month, np.nan, dtype=np.float32)
         if len(tempo_data_db) > 0:
             tempo_data[tempo_data_db[0] - 1] = tempo_data_db[1]
-        fig.add_trace(go.Heatmap(
-            z=tempo_data.reshape((days_in_month, 1)),
-            zmin=1,
-            # zmax=nanmax(month_data),
-            zmax=3,
-            colorscale=[
-                [0, "rgb(21, 101, 192)"],
-                [0.5, "rgb(240, 240, 240)"],
-                [1, "rgb(198, 40, 40)"]
-            ],
-            text=[[["n/a", "Bleu", "Blanc", "Rouge"][0 if math.isnan(x) else int(x)]] for x in tempo_data],
-            hovertemplate=f"%{{y}}/{m:02d}: Jour %{{text}}<extra></extra>",
-            showscale=False,
-            ygap=1
-        ), row=1, col=1)
         month_data_db = np.transpose(np.array(cur.execute(
-            "SELECT (day - 1) * 48 + slice, value FROM consumption WHERE year = ? AND month = ? ORDER BY day, slice",
+            "SELECT (day - 1) * 48 + slice, value FROM consumption_all WHERE year = ? AND month = ? ORDER BY day, slice",
             (y, m)).fetchall(),
                                               dtype=np.int32))
         month_data = np.full(48 * days_in_month, np.nan, dtype=np.float32)
         if len(month_data_db) > 0:
             month_data[month_data_db[0]] = month_data_db[1]
-        month_data = month_data.reshape((days_in_month, 48)) / 2
-        fig.add_trace(go.Heatmap(
-            z=month_data,
-            zmin=0,
-            # zmax=nanmax(month_data),
-            zmax=2000,
-            colorscale='hot',
-            colorbar=dict(
-                x=0.748,
-                ticksuffix="&nbsp;Wh",
-                tickformat="d",
-            ),
-            text=[[*timelabels[1:], "00:00"]] * days_in_month,
-            hovertemplate=f"%{{y}}/{m:02d}, %{{x}}-%{{text}}: %{{z}} Wh<extra></extra>"), row=1, col=2)
-        fig.update_yaxes(tickvals=list(range(days_in_month)), ticktext=list(map(str, range(1, days_in_month + 1))))
-        sum_per_day = np.nansum(month_data, axis=1).reshape((-1, 1)) / 1000
-        sum_per_day[np.isnan(month_data).all(axis=1)] = np.nan
-        fig.add_trace(go.Heatmap(
-            z=sum_per_day,
-            zmin=0,
-            # zmax=nanmax(sum_per_day),
-            zmax=40,
-            colorscale='hot',
-            colorbar=dict(
-                x=1,
-                ticksuffix="&nbsp;kWh",
-                tickformat="d"
-            ),
-            hovertemplate=f"%{{y}}/{m:02d}: %{{z:.1f}} kWh<extra></extra>"), row=1, col=3)
-        plot.update()
+        return tempo_data, month_data.reshape((days_in_month, 48)) / 2
+
+    return data_cache.cached(("heatmap", y, m), compute)
+
+
+@tab("Consommation par jour")
+def content():
+    def update_plot(y, m):
+        tempo_data, month_data = month_heatmap_data(y, m)
+        tempo = np.nan_to_num(tempo_data).astype(np.uint8)
+        plot.client.run_javascript(f"showHeatmap({plot.id}, '{m:02d}', '{encode_array(tempo)}', "
+                                   f"'{encode_array(month_data.astype('<f4'))}')")
 
     date_sel = YearMonthInput(update_plot)
     date_sel.view()
 
+    # only the data changes from one month to the other, so the figure is sent once and filled by showHeatmap
     fig = make_subplots(rows=1, cols=3, column_widths=[0.03, 0.75, 0.15], subplot_titles=("Tempo", "Consommation", "Total par jour"),
                         horizontal_spacing=0, specs=[
             [{}, {"l": 0.02, "r": 0.09}, {}]
         ])
     timelabels = [f"{i:02d}:{j:02d}" for i in range(24) for j in (0, 30)]
-    fig.update_yaxes(autorange="reversed")
-    fig.update_xaxes(tickvals=list(range(48)), ticktext=timelabels, col=2)
+    slot_labels = [f"{a}-{b}" for a, b in zip(timelabels, [*timelabels[1:], "00:00"])]
+    fig.add_trace(go.Heatmap(
+        z=[],
+        zmin=1,
+        zmax=3,
+        colorscale=[
+            [0, "rgb(21, 101, 192)"],
+            [0.5, "rgb(240, 240, 240)"],
+            [1, "rgb(198, 40, 40)"]
+        ],
+        hovertemplate="%{y}/%{meta}: Jour %{text}<extra></extra>",
+        showscale=False,
+        ygap=1
+    ), row=1, col=1)
+    fig.add_trace(go.Heatmap(
+        z=[],
+        x=slot_labels,
+        zmin=0,
+        zmax=2000,
+        colorscale='hot',
+        colorbar=dict(
+            x=0.748,
+            ticksuffix="&nbsp;Wh",
+            tickformat="d",
+        ),
+        hovertemplate="%{y}/%{meta}, %{x}: %{z} Wh<extra></extra>"), row=1, col=2)
+    fig.add_trace(go.Heatmap(
+        z=[],
+        zmin=0,
+        zmax=40,
+        colorscale='hot',
+        colorbar=dict(
+            x=1,
+            ticksuffix="&nbsp;kWh",
+            tickformat="d"
+        ),
+        hovertemplate="%{y}/%{meta}: %{z:.1f} kWh<extra></extra>"), row=1, col=3)
+    fig.update_yaxes(autorange="reversed", tickmode="linear", tick0=1, dtick=1)
+    fig.update_xaxes(tickvals=slot_labels, ticktext=timelabels, col=2)
     fig.update_xaxes(visible=False, col=3)
     fig.update_xaxes(visible=False, col=1)
     fig.update_yaxes(showticklabels=False, col=1)
     plot = ui.plotly(fig).classes('h-full w-full')
     update_plot(date_sel.year, date_sel.month)
 
+    def data_changed(change):
+        y, m = date_sel.year, date_sel.month
+        if change.table in ("consumption", "tempo") and change.overlaps(date(y, m, 1), date(y, m, monthrange(y, m)[1])):
+            update_plot(y, m)
+    on_data_change(data_changed)
+
 
 @tab("Coût")
 def content():
@@ -154,37 +241,45 @@ def content():
 
     compare_base = "base"
     plans_show = [p.value for p in (EdfPlan.BASE, EdfPlan.HPHC, EdfPlan.TEMPO, EdfPlan.ZENFLEX)]
+    # range of days covered by the displayed table, and how to reload its rows in place
+    shown = {}
 
     @ui.refreshable
     def price_table():
         match period_kind.value:
             case "quotidien":
-                queries = ["strftime('%d/%m', c.date)", f"c.date LIKE '{daily_period.year}-{daily_period.month:02d}%'"]
+                group = "strftime('%d/%m', c.date)"
+                start = date(daily_period.year, daily_period.month, 1)
+                end = date(daily_period.year, daily_period.month, monthrange(daily_period.year, daily_period.month)[1])
                 col = "Jour"
             case "mensuel":
-                queries = ["strftime('%Y-%m', c.date)", "1"]
+                group, start, end = "strftime('%Y-%m', c.date)", None, None
                 col = "Mois"
             case "annuel":
-                queries = ["strftime('%Y', c.date)", "1"]
+                group, start, end = "strftime('%Y', c.date)", None, None
                 col = "Année"
             case _:
                 raise NotImplemented
 
         columns = [
-            dict(name="month", label=col, field="month", rowspan=2),
-            {'name': "kwh", 'label': "kWh", 'field': "kwh", "rowspan": 2},
+            dict(name="month", label=col, field="month", rowspan=2, sortable=True),
+            {'name': "kwh", 'label': "kWh", 'field': "kwh", "rowspan": 2, "sortable": True},
         ]
 
         plans_obj = list(map(EdfPlan, plans_show))
 
         for plan in plans_obj:
             columns.append(dict(name=f"plan_{plan.value}_disp", label=f"{plan.display_name()}", colspan=2, align="center"))
-            columns.append(dict(name=f"plan_{plan.value}", label=f"Prix", field=f"plan_{plan.value}", sub=True))
+            columns.append(dict(name=f"plan_{plan.value}", label=f"Prix", field=f"plan_{plan.value}", sub=True,
+                                sortable=True))
             columns.append({'name': f"diff_{plan.value}", 'label': f"% {EdfPlan(compare_base).display_name()}",
-                            'field': f"diff_{plan.value}", 'sub': True})
+                            'field': f"diff_{plan.value}", 'sub': True, 'sortable': True})
+
+        q = query_plan_prices_period(plans_obj, price_mode.value, group, with_total=True, source="consumption_approx")
 
-        q = query_plan_prices_period(plans_obj, price_mode.value, with_total=True, *queries)
-        conso = cur.execute(q).fetchall()
+        def fetch():
+            return data_cache.cached(("prices", q, start, end), lambda: cur.execute(q, query_params(start, end)).fetchall())
+        *conso, total = fetch()
 
         def process(row):
             res = {"month": row[0], "kwh": f"{row[1] / 1000 if row[1] is not None else float('nan'):.1f}"}
@@ -211,7 +306,53 @@ def content():
                 res[f"diff_{p.value}"], res[f"diff_{p.value}_bgcolor"] = text, f"background-color: {color}"
             return res
 
-        rows = [process(row) for row in conso]
+        def sort_key(name):
+            """
+            Gives a function that maps a raw row to the value it is sorted by for column `name`, None if unknown.
+            """
+            if name == "kwh":
+                return lambda row: row[1]
+            kind, _, plan = (name or "").partition("_")
+            if kind not in ("plan", "diff"):
+                return None
+            i = 2 + plans_show.index(plan)
+            base = 2 + plans_show.index(compare_base)
+
+            def key(row):
+                if row[i] is None or math.isinf(row[i]):
+                    return None
+                if kind == "plan":
+                    return row[i]
+                if row[base] is None or math.isinf(row[base]) or not row[base]:
+                    return None
+                return row[i] / row[base]
+            return key
+
+        def window(pagination):
+            """
+            Gives the formatted rows of the requested page, sorted server-side, followed by the pinned total row.
+            """
+            rows = conso
+            if key := sort_key(pagination.get("sortBy")):
+                keyed = [(key(row), row) for row in conso]
+                rows = sorted([r for r in keyed if r[0] is not None], key=lambda r: r[0],
+                              reverse=pagination.get("descending", False))
+                rows = [row for _, row in rows] + [row for k, row in keyed if k is None]
+            elif pagination.get("descending"):
+                rows = rows[::-1]
+            per_page = pagination["rowsPerPage"] or len(rows)
+            start = (pagination["page"] - 1) * per_page
+            return [process(row) for row in rows[start:start + per_page]] + [process(total)]
+
+        pagination = {"page": 1, "rowsPerPage": ROWS_PER_PAGE, "rowsNumber": len(conso), "sortBy": None,
+                      "descending": False}
+        rows = window(pagination)
+
+        def estimated_text():
+            days = aggregates.estimated_days(cur, start, end)
+            return f"{days} jours sans courbe de charge sont estimés à partir de la consommation quotidienne." \
+                if days else ""
+        estimated = ui.label(estimated_text())
 
         ui.html("""
         <style>
@@ -234,8 +375,46 @@ def content():
             font-weight: bold;
         }
         </style>""")
-        table = ui.table(columns=columns, rows=rows).classes("h-full w-full table-fixed overflow-auto price-table")
+        table = ui.table(columns=columns, rows=rows, row_key="month", pagination=pagination) \
+            .classes("h-full w-full table-fixed overflow-auto price-table")
         table.props("separator=cell wrap-cells dense")
+        if len(conso) <= ROWS_PER_PAGE:
+            table.props("hide-bottom")
+
+        def request(e):
+            requested = {**e.args["pagination"], "rowsNumber": len(conso)}
+            table.rows = window(requested)
+            table.pagination = requested
+        table.on("request", request, ["pagination"])
+
+        def patch(change: fetch_edf.DataChange):
+            """
+            Reloads the rows after new data came in, keeping the table, its page and its sort order. Without bounds,
+            only the periods `change` affects are queried again.
+            """
+            nonlocal conso, total
+            # Tempo days also price the early hours of the following day
+            lo, hi = change.start, change.end + timedelta(days=1) if change.end < date.max else change.end
+            if start is not None or lo == date.min or hi == date.max or not conso:
+                *conso, total = fetch()
+            else:
+                if period_kind.value == "mensuel":
+                    lo, hi = lo.replace(day=1), hi.replace(day=monthrange(hi.year, hi.month)[1])
+                else:
+                    lo, hi = date(lo.year, 1, 1), date(hi.year, 12, 31)
+                partial = query_plan_prices_period(plans_obj, price_mode.value, group, source="consumption_approx")
+                updated = data_cache.cached(("prices", partial, lo, hi),
+                                            lambda: cur.execute(partial, query_params(lo, hi)).fetchall())
+                conso = sorted({**{row[0]: row for row in conso}, **{row[0]: row for row in updated}}.values())
+                total = ("Total", *(sum(v for v in column if v is not None)
+                                    for column in zip(*(row[1:] for row in conso))))
+            table.pagination = {**table.pagination, "rowsNumber": len(conso)}
+            table.rows = window(table.pagination)
+            if len(conso) > ROWS_PER_PAGE:
+                table.props(remove="hide-bottom")
+            estimated.text = estimated_text()
+        shown.update(start=start, end=end, patch=patch)
+
         for p in EdfPlan:
             table.add_slot(f"body-cell-plan_{p.value}_disp", f'''<q-td key="plan_{p.value}_disp" :props="props" style="border-left-width: 3px;">'''
                            + "{{ props.value }}</q-td>")
@@ -264,6 +443,38 @@ def content():
                 </q-tr>
             ''')
 
+    shifted_loads = [
+        load_shifting.FlexibleLoad("Véhicule électrique", 10000, 7400, 36, 16),
+        load_shifting.FlexibleLoad("Chauffe-eau", 5000, 2400, 14, 14),
+    ]
+    shifted_enabled = [False] * len(shifted_loads)
+    @ui.refreshable
+    def shifting_table():
+        consumption_history = data_cache.cached("history", history.load_history)
+        loads = [load for load, enabled in zip(shifted_loads, shifted_enabled) if enabled]
+        if not loads:
+            ui.label("Activez une charge pour simuler son déplacement vers les créneaux les moins chers.")
+            return
+
+        def fmt(v):
+            return "-" if math.isinf(v) else "{0:.2f} €".format(v / 10000000)
+
+        rows = []
+        for plan, (before, after) in load_shifting.simulate(consumption_history, loads, list(map(EdfPlan, plans_show)),
+                                                            price_mode.value).items():
+            rows.append({"plan": plan.display_name(), "before": fmt(before), "after": fmt(after),
+                         "saved": "-" if math.isinf(before) else fmt(before - after)})
+        ui.table(columns=[
+            {"name": "plan", "label": "Offre", "field": "plan", "align": "left"},
+            {"name": "before", "label": "Coût réel", "field": "before"},
+            {"name": "after", "label": "Coût avec déplacement", "field": "after"},
+            {"name": "saved", "label": "Économie", "field": "saved"},
+        ], rows=rows).props("separator=cell dense")
+
+    def refresh_tables():
+        price_table.refresh()
+        shifting_table.refresh()
+
     def base_changed(e):
         nonlocal compare_base
         compare_base = e.value
@@ -278,10 +489,10 @@ def content():
         plans.set_value(plans_show)
         if compare_base not in plans_show:
             base_select.set_value(plans_show[0])
-        price_table.refresh()
+        refresh_tables()
 
     with ui.row().classes("items-end"):
-        price_mode = ui.select({"real": "Tarif au moment de la consommation", "current": "Tarif actuel"}, value="current", label="Mode de calcul", on_change=price_table.refresh)
+        price_mode = ui.select({"real": "Tarif au moment de la consommation", "current": "Tarif actuel"}, value="current", label="Mode de calcul", on_change=refresh_tables)
         base_select = ui.select({p.value: p.display_name() for p in EdfPlan}, value=compare_base, label="Base 100%", on_change=base_changed)
         plans = ui.select({p.value: p.display_name() for p in EdfPlan}, label="Offres à comparer",
                           multiple=True,
@@ -302,10 +513,306 @@ def content():
 
     price_table()
 
+    with ui.expansion("Simulation de déplacement de consommation").classes("w-full"):
+        def set_field(i, field, value):
+            if field == "enabled":
+                shifted_enabled[i] = value
+            elif value is not None:
+                setattr(shifted_loads[i], field, value)
+            shifting_table.refresh()
+
+        slice_labels = {i: f"{i // 2:02d}:{i % 2 * 30:02d}" for i in range(48)}
+        for i, load in enumerate(shifted_loads):
+            with ui.row().classes("items-end"):
+                ui.switch(load.name, value=shifted_enabled[i],
+                          on_change=lambda e, i=i: set_field(i, "enabled", e.value))
+                ui.number("Énergie par jour", value=load.energy / 1000, suffix="kWh", min=0,
+                          on_change=lambda e, i=i: set_field(i, "energy", e.value and e.value * 1000))
+                ui.number("Puissance max", value=load.max_power / 1000, suffix="kW", min=0.1,
+                          on_change=lambda e, i=i: set_field(i, "max_power", e.value and e.value * 1000))
+                ui.select(slice_labels, value=load.start, label="Début",
+                          on_change=lambda e, i=i: set_field(i, "start", e.value))
+                ui.select(slice_labels, value=load.end, label="Fin",
+                          on_change=lambda e, i=i: set_field(i, "end", e.value))
+        shifting_table()
+
+    def data_changed(change):
+        # Tempo days also price the early hours of the following day
+        if change.overlaps(shown["start"] and shown["start"] - timedelta(days=1), shown["end"]):
+            shown["patch"](change)
+        # the simulation works on the load curve, the daily totals don't change it
+        if any(shifted_enabled) and change.table in ("consumption", "tempo", "edf_plan_slice"):
+            shifting_table.refresh()
+    on_data_change(data_changed)
+
+
+@tab("Solaire")
+def content():
+    consumption_history = data_cache.cached("history", history.load_history)
+    uploaded_production = None
+    uploaded_csv = None
+    plans_obj = [EdfPlan.BASE, EdfPlan.HPHC, EdfPlan.TEMPO, EdfPlan.ZENFLEX]
+    sweep_sizes = np.arange(0, 21)
+
+    def fmt(v):
+        return "-" if math.isinf(v) else "{0:.2f} €".format(v / 10000000)
+
+    @ui.refreshable
+    def results():
+        if uploaded_production is not None:
+            production = uploaded_production
+        else:
+            production = solar.clear_sky_production(consumption_history.days, (peak_power.value or 0) * 1000)
+        # an emptied field gives None, and a battery without any efficiency would divide by 0
+        round_trip = max((efficiency.value or 0) / 100, 0.01)
+        battery = solar.Battery((capacity.value or 0) * 1000, (battery_power.value or 0) * 1000, round_trip)
+        batteries = [solar.Battery(0, 0), battery] + [solar.Battery(size * 1000, battery.max_power, battery.efficiency)
+                                                      for size in sweep_sizes]
+        costs = solar.sweep_costs(consumption_history, production, batteries, plans_obj, price_mode.value)
+        without_pv = {plan: costs[0] for plan, costs in solar.sweep_costs(
+            consumption_history, np.zeros_like(production), batteries[:1], plans_obj, price_mode.value).items()}
+        pv_only = solar.simulate(consumption_history, production)
+        with_battery = solar.simulate(consumption_history, production, battery)
+
+        ui.label(f"Production : {np.nansum(production) / 1000:.0f} kWh, autoconsommation : "
+                 f"{100 * pv_only.self_consumption(production):.0f} % sans batterie, "
+                 f"{100 * with_battery.self_consumption(production):.0f} % avec batterie")
+        ui.table(columns=[
+            {"name": "plan", "label": "Offre", "field": "plan", "align": "left"},
+            {"name": "none", "label": "Sans PV", "field": "none"},
+            {"name": "pv", "label": "PV seul", "field": "pv"},
+            {"name": "battery", "label": "PV + batterie", "field": "battery"},
+        ], rows=[
+            {"plan": plan.display_name(), "none": fmt(without_pv[plan]), "pv": fmt(costs[plan][0]),
+             "battery": fmt(costs[plan][1])} for plan in plans_obj
+        ]).props("separator=cell dense")
+
+        fig = go.Figure([go.Scatter(x=sweep_sizes, y=costs[plan][2:] / 10000000, name=plan.display_name())
+                         for plan in plans_obj])
+        fig.update_layout(xaxis_title="Capacité de la batterie (kWh)", yaxis_title="Coût (€)",
+                          margin=dict(l=0, r=0, t=20, b=0))
+        ui.plotly(fig).classes("w-full")
+
+    def production_uploaded(e):
+        nonlocal uploaded_production, uploaded_csv
+        uploaded_csv = e.content.read().decode("utf-8")
+        uploaded_production = solar.production_from_csv(uploaded_csv, consumption_history.days)
+        results.refresh()
+
+    def data_changed(change):
+        nonlocal consumption_history, uploaded_production
+        match change.table:
+            case "consumption" | "tempo":
+                consumption_history = data_cache.cached("history", history.load_history)
+                if uploaded_csv is not None:
+                    uploaded_production = solar.production_from_csv(uploaded_csv, consumption_history.days)
+            case "edf_plan_slice":
+                # only the prices changed, the history stays
+                pass
+            case _:
+                # the simulation works on the load curve, the daily totals don't change it
+                return
+        results.refresh()
+    on_data_change(data_changed)
+
+    with ui.row().classes("items-end"):
+        price_mode = ui.select({"real": "Tarif au moment de la consommation", "current": "Tarif actuel"},
+                               value="current", label="Mode de calcul", on_change=results.refresh)
+        peak_power = ui.number("Puissance crête", value=3, suffix="kWc", min=0, on_change=results.refresh)
+        capacity = ui.number("Capacité batterie", value=5, suffix="kWh", min=0, on_change=results.refresh)
+        battery_power = ui.number("Puissance batterie", value=2.5, suffix="kW", min=0, on_change=results.refresh)
+        efficiency = ui.number("Rendement", value=90, suffix="%", min=1, max=100, on_change=results.refresh)
+        ui.upload(label="Production mesurée (CSV)", auto_upload=True, on_upload=production_uploaded)
+
+    results()
+
 
 @tab("Statistiques")
 def content():
-    ui.label("Rien ici pour l'instant")
+    @ui.refreshable
+    def statistics():
+        show_statistics(analytics.get())
+    statistics()
+    on_data_change(lambda change: change.table in ("consumption", "consumption_daily", "tempo")
+                   and statistics.refresh())
+
+
+def show_cohort():
+    """
+    Shows where the meter stands in its cohort, if an index was built with `main.py cohort` and set in `COHORT_INDEX`.
+    """
+    index = cohort.load_index(config["COHORT_INDEX"]) if config.get("COHORT_INDEX") else None
+    if index is None:
+        return
+    meter_features = data_cache.cached("cohort_features", lambda: cohort.features(cohort.last_year()))
+    if meter_features is None:
+        return
+    plan = config.get("CURRENT_PLAN") or None
+    if (ranked := cohort.rank(index, db.sub_power, plan, meter_features)) is None:
+        return
+    key, ranks = ranked
+    name = cohort.cohort_name(key)
+    with ui.column().classes("gap-0"):
+        for feature, rank in ranks.items():
+            ui.label(f"Votre {cohort.FEATURES[feature]} est au {100 * rank:.0f}e centile des {name}")
+        if cheapest := index["cohorts"][key]["cheapest"]:
+            ui.label("Offre la moins chère parmi les " + name + " : " + ", ".join(
+                f"{EdfPlan(plan).display_name()} ({100 * share:.0f} %)"
+                for plan, share in sorted(cheapest.items(), key=lambda item: -item[1])))
+
+
+def show_statistics(stats: analytics.Analytics):
+    if stats.first_day is None:
+        ui.label("La courbe de charge n'est pas encore récupérée, les valeurs quotidiennes sont affichées en attendant.")
+        show_month_totals()
+        return
+
+    timelabels = [f"{i:02d}:{j:02d}" for i in range(24) for j in (0, 30)]
+
+    ui.label(f"Du {stats.first_day:%d/%m/%Y} au {stats.last_day:%d/%m/%Y}")
+    ui.label(f"Consommation de base (nuit, dernière année) : {stats.baseload:.0f} W")
+    show_cohort()
+
+    with ui.row().classes("w-full"):
+        for title, names, profile in (("Profil moyen par jour de la semaine", analytics.WEEKDAYS, stats.weekday_profile),
+                                      ("Profil moyen par saison", analytics.SEASONS, stats.season_profile)):
+            fig = go.Figure([go.Scatter(x=timelabels, y=row * 2, name=name) for name, row in zip(names, profile)])
+            fig.update_layout(title=title, yaxis_title="Puissance moyenne (W)", margin=dict(l=0, r=0, t=40, b=0))
+            ui.plotly(fig).classes("w-[48%]")
+
+    fig = go.Figure(go.Scatter(x=stats.baseload_months, y=stats.baseload_monthly))
+    fig.update_layout(title="Consommation de base par mois", yaxis_title="W", margin=dict(l=0, r=0, t=40, b=0))
+    ui.plotly(fig).classes("w-full")
+
+    with ui.row().classes("w-full items-start"):
+        ui.table(columns=[
+            {"name": "color", "label": "Couleur Tempo", "field": "color", "align": "left"},
+            {"name": "days", "label": "Jours", "field": "days"},
+            {"name": "kwh", "label": "kWh", "field": "kwh"},
+            {"name": "per_day", "label": "kWh/jour", "field": "per_day"},
+        ], rows=[
+            {"color": name, "days": int(days), "kwh": f"{energy / 1000:.1f}",
+             "per_day": f"{energy / 1000 / days:.1f}" if days else "-"}
+            for name, energy, days in zip(analytics.TEMPO_COLORS, stats.tempo_energy, stats.tempo_days)
+        ]).props("separator=cell dense")
+
+        ui.table(columns=[
+            {"name": "month", "label": "Mois", "field": "month", "align": "left"},
+            {"name": "kwh", "label": "kWh", "field": "kwh"},
+            {"name": "previous", "label": "Année précédente", "field": "previous"},
+            {"name": "delta", "label": "Écart", "field": "delta"},
+        ], rows=[
+            {"month": month, "kwh": f"{energy / 1000:.1f}", "previous": f"{previous / 1000:.1f}",
+             "delta": "{0:+.1f}%".format(100 * delta)}
+            for month, energy, previous, delta in stats.year_over_year()
+        ]).props("separator=cell dense")
+
+        ui.table(columns=[
+            {"name": "day", "label": "Jours les plus consommateurs", "field": "day", "align": "left"},
+            {"name": "kwh", "label": "kWh", "field": "kwh"},
+            {"name": "peak", "label": "Pic (W)", "field": "peak"},
+        ], rows=[
+            {"day": f"{day:%d/%m/%Y}", "kwh": f"{energy / 1000:.1f}", "peak": f"{peak:.0f}"}
+            for day, energy, peak in stats.peak_days
+        ]).props("separator=cell dense")
+
+        show_month_totals()
+
+
+def show_month_totals():
+    ui.table(columns=[
+        {"name": "month", "label": "Mois", "field": "month", "align": "left"},
+        {"name": "kwh", "label": "kWh", "field": "kwh"},
+        {"name": "complete", "label": "Données", "field": "complete"},
+        {"name": "peak", "label": "Pic (VA)", "field": "peak"},
+    ], rows=[
+        {"month": f"{year:04d}-{month:02d}", "kwh": f"{'≈ ' if estimated else ''}{energy / 1000:.1f}",
+         "complete": f"{100 * complete:.0f} %", "peak": "-" if peak is None else str(peak)}
+        for year, month, energy, complete, estimated, peak in aggregates.month_totals(cur)
+    ]).props("separator=cell dense")
+
+
+@tab("Prévisions")
+def content():
+    @ui.refreshable
+    def forecasts():
+        show_forecasts(forecast.get())
+    forecasts()
+    on_data_change(lambda change: change.table in ("consumption", "tempo", "edf_plan_slice") and forecasts.refresh())
+
+
+def show_forecasts(forecasts: list[forecast.Forecast]):
+    if not forecasts:
+        ui.label("Pas encore assez de données pour établir une prévision.")
+        return
+
+    def fmt(v):
+        return "-" if math.isinf(v) else "{0:.2f} €".format(v / 10000000)
+
+    with ui.row().classes("w-full items-start"):
+        for f in forecasts:
+            with ui.column():
+                ui.label(f"{f.name} (du {f.start:%d/%m/%Y} au {f.end:%d/%m/%Y})").classes("text-lg")
+                if f.measured_until is not None:
+                    ui.label(f"Mesuré jusqu'au {f.measured_until:%d/%m/%Y} : {f.energy_measured / 1000:.0f} kWh, "
+                             f"reste estimé : {f.energy_projected / 1000:.0f} kWh")
+                else:
+                    ui.label(f"Estimé : {f.energy_projected / 1000:.0f} kWh")
+                if f.tempo_red or f.tempo_white:
+                    ui.label(f"Jours Tempo restants attendus : {f.tempo_red:.1f} rouges, {f.tempo_white:.1f} blancs")
+                ui.table(columns=[
+                    {"name": "plan", "label": "Offre", "field": "plan", "align": "left"},
+                    {"name": "measured", "label": "Mesuré", "field": "measured"},
+                    {"name": "projected", "label": "Reste estimé", "field": "projected"},
+                    {"name": "total", "label": "Total estimé", "field": "total"},
+                ], rows=[
+                    {"plan": plan.display_name(), "measured": fmt(f.cost_measured[plan]),
+                     "projected": fmt(f.cost_projected[plan]), "total": fmt(f.total(plan))}
+                    for plan in sorted(EdfPlan, key=f.total)
+                ]).props("separator=cell dense")
+
+
+profiling.install_nicegui()
+
+app.include_router(api.router)
+
+
+@ui.page("/profiling")
+def profiling_page():
+    """
+    Hidden page for turning profiling on and off and getting the recorded profiles.
+    """
+    ui.switch("Profilage activé", value=profiling.enabled, on_change=lambda e: profiling.enable(e.value))
+
+    @ui.refreshable
+    def profiles():
+        if not profiling.profiles:
+            ui.label("Aucun profil enregistré.")
+            return
+        for p in reversed(profiling.profiles):
+            with ui.expansion(f"#{p.id} {p.name} — {p.started:%H:%M:%S}, {p.duration * 1000:.0f} ms, "
+                              f"{sum(p.samples.values())} échantillons, pic mémoire "
+                              + (f"{p.peak / 1024:.0f} Kio" if p.peak is not None else "partagé avec d'autres profils")):
+                ui.link("Pile repliée (flamegraph.pl, speedscope)", f"/profiling/{p.id}.folded", new_tab=True)
+                ui.table(columns=[
+                    {"name": "line", "label": "Ligne", "field": "line", "align": "left"},
+                    {"name": "size", "label": "Kio alloués", "field": "size"},
+                    {"name": "count", "label": "Allocations", "field": "count"},
+                ], rows=[
+                    {"line": line, "size": f"{size / 1024:+.1f}", "count": f"{count:+d}"}
+                    for line, size, count in p.allocations
+                ]).props("separator=cell dense")
+
+    ui.button("Actualiser", on_click=profiles.refresh)
+    profiles()
+
+
+@app.get("/profiling/{profile_id}.folded")
+def profiling_folded(profile_id: int):
+    if (p := profiling.get(profile_id)) is None:
+        raise HTTPException(404, "profile not found")
+    return PlainTextResponse(p.folded(), headers={
+        "Content-Disposition": f'attachment; filename="profile-{p.id}.folded"'})
 
 
 @ui.page("/app")
@@ -326,24 +833,29 @@ def index():
             }
         </style>
     """)
-
-    @ui.refreshable
-    def all_tabs():
-        with ui.tabs().classes("w-full") as tabbar:
-            for i, (name, *_) in enumerate(tabs):
-                tabs[i][2] = ui.tab(name)
-        with ui.tab_panels(tabbar, value=tabs[0][2]).classes("w-full h-full"):
-            for name, f, *_ in tabs:
-                with ui.tab_panel(name):
-                    f()
+    ui.add_head_html(f"<script>{HEATMAP_JS}</script>")
 
     with ui.row():
-        async def reload():
-            await fetch_edf.fetch_apis()
-            all_tabs.refresh()
-        ui.button("Forcer màj Enedis", on_click=reload)
-
-    all_tabs()
+        # the tabs update themselves from the changes the fetch reports
+        ui.button("Forcer màj Enedis", on_click=fetch_edf.fetch_apis)
+
+    # tabs are only built when they are first shown
+    panels = {}
+    rendered = set()
+
+    def show(name):
+        if name not in rendered:
+            rendered.add(name)
+            with panels[name]:
+                dict(tabs)[name]()
+
+    with ui.tabs().classes("w-full") as tabbar:
+        for name, _ in tabs:
+            ui.tab(name)
+    with ui.tab_panels(tabbar, value=tabs[0][0], on_change=lambda e: show(e.value)).classes("w-full h-full"):
+        for name, _ in tabs:
+            panels[name] = ui.tab_panel(name)
+    show(tabs[0][0])
 
     context.get_client().content.classes('h-[100vh]')
 
@@ -6,7 +6,9 @@ async def run_ui():
     import db
     await db.load_meter_info()
     import fetch_edf
-    await fetch_edf.fetch_loop()
+    await fetch_edf.fetch_loop(progressive=True)
+    # the load curve fills in once the server runs, the open pages updating as it comes
+    nui.app.on_startup(fetch_edf.fetch_apis)
     import ui
     _ = ui
     @nui.page("/")